@@ -0,0 +1,274 @@
+from __future__ import division, print_function
+from timeit import default_timer as timer
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from qfp.db import QfpDB
+from qfp.fingerprint import fpType, ReferenceFingerprint, QueryFingerprint
+from qfp.quads import find_quads
+from qfp.utils import stft, find_peaks, n_strongest, generate_hash
+
+from .synth import SAMPLE_RATE, track, sweep, noise, change_speed, add_noise
+
+"""
+Benchmarks every fingerprinting stage and QfpDB at several catalog
+sizes on deterministic synthetic audio. Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json
+
+Results are written as JSON. Compared against a baseline (the JSON of
+an earlier run), slower timings beyond the tolerance and lower
+recognition accuracy are reported as regressions and make the run
+exit with status 1.
+"""
+
+SIGNALS = {'track': track, 'sweep': sweep, 'noise': noise}
+SPEEDS = (0.95, 1.0, 1.05)
+STAGES = ('stft', 'find_peaks', 'find_quads', 'n_strongest', 'generate_hash')
+
+
+def bench_stages(seconds, repeat=3, seed=0):
+    """
+    Times each stage of a reference fingerprint on every kind of
+    synthetic signal. Each stage gets the output of the previous one.
+    Returns: {signal: {stage: stats}}, stats holding the best time of
+    repeat runs, seconds of audio per second and peak memory in MiB
+    """
+    q, r, c, w, h = fpType.Reference
+    results = {}
+    for name, generate in sorted(SIGNALS.items()):
+        samples = generate(seconds, seed)
+        stages = [('stft', lambda: stft(samples)),
+                  ('find_peaks', lambda: find_peaks(out['stft'], w, h)),
+                  ('find_quads', lambda: find_quads(
+                      out['find_peaks'], r, c)),
+                  ('n_strongest', lambda: n_strongest(
+                      out['stft'], out['find_quads'], q)),
+                  ('generate_hash', lambda: generate_hash(
+                      out['n_strongest']))]
+        out = {}
+        results[name] = {}
+        for stage, run in stages:
+            best, out[stage] = _best_time(run, repeat)
+            results[name][stage] = {
+                'seconds': best,
+                'throughput': seconds / best if best else None,
+                'peak_mb': _peak_memory(run),
+                'items': len(out[stage])}
+    return results
+
+
+def bench_db(sizes, seconds, queries, seed=0, clip=15, snr=20,
+             compact=False):
+    """
+    Stores catalogs of sizes synthetic tracks and queries each with the
+    same clips: speed-changed, noisy excerpts of tracks in the smallest
+    catalog. compact selects the storage format of the catalogs.
+    Returns: {size: stats}
+    """
+    rng = np.random.RandomState(seed)
+    tracks = [track(seconds, seed + i) for i in range(max(sizes))]
+    references = []
+    for samples in tracks:
+        fp = ReferenceFingerprint(samples)
+        fp.create()
+        references.append(fp)
+    clips = []
+    for i in range(queries):
+        t = rng.randint(min(sizes))
+        factor = SPEEDS[i % len(SPEEDS)]
+        start = rng.randint(int((seconds - clip * 1.1) * SAMPLE_RATE))
+        excerpt = tracks[t][start:start + int(clip * 1.1 * SAMPLE_RATE)]
+        samples = add_noise(change_speed(excerpt, factor), snr, seed + i)
+        fp = QueryFingerprint(samples)
+        fp.create()
+        clips.append((_title(t), fp))
+    results = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'catalog%d.db' % size)
+            results[str(size)] = _bench_catalog(
+                QfpDB(path, compact=compact), references[:size], clips)
+            results[str(size)]['db_mb'] = os.path.getsize(path) / 2 ** 20
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def _bench_catalog(db, references, clips):
+    """
+    Returns store and query timings and top-1 accuracy on one catalog
+    """
+    times = []
+    for i, fp in enumerate(references):
+        start = timer()
+        db.store(fp, _title(i))
+        times.append(timer() - start)
+    stats = {'store': _latencies(times)}
+    times, correct = [], 0
+    for title, fp in clips:
+        start = timer()
+        db.query(fp)
+        times.append(timer() - start)
+        if fp.matches:
+            best = max(fp.matches, key=lambda m: m.vScore)
+            correct += best.record == title
+    stats['query'] = _latencies(times)
+    stats['accuracy'] = correct / len(clips) if clips else None
+    db.close()
+    return stats
+
+
+def _title(i):
+    return 'track%04d' % i
+
+
+def _best_time(run, repeat):
+    """
+    Returns: (best time of repeat calls of run, result of the last call)
+    """
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        result = run()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _peak_memory(run):
+    """
+    Returns peak memory allocated while calling run, in MiB
+    """
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def _latencies(times):
+    """
+    Returns total, mean and percentile latencies (seconds) and rate
+    """
+    times = np.array(times)
+    if len(times) == 0:
+        return {}
+    return {'total': float(times.sum()), 'mean': float(times.mean()),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'per_second': len(times) / float(times.sum())}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares results to a baseline run. Timings more than tolerance
+    slower and any drop in accuracy are regressions.
+    Returns: (report lines, regressions)
+    """
+    lines, regressions = [], []
+
+    def check(name, new, old, accuracy=False):
+        if new is None or old is None:
+            return
+        ratio = new / old if old else float('inf')
+        lines.append("%-36s %12.4f %12.4f %7.2fx" % (name, old, new, ratio))
+        if (new < old) if accuracy else (ratio > 1 + tolerance):
+            regressions.append(name)
+
+    for signal, stages in sorted(results.get('stages', {}).items()):
+        for stage in STAGES:
+            old = baseline.get('stages', {}).get(signal, {}).get(stage)
+            if stage in stages and old:
+                check('%s/%s seconds' % (signal, stage),
+                      stages[stage]['seconds'], old['seconds'])
+    for size, stats in sorted(results.get('catalogs', {}).items(),
+                              key=lambda kv: int(kv[0])):
+        old = baseline.get('catalogs', {}).get(size)
+        if not old:
+            continue
+        check('%s tracks store mean' % size,
+              stats['store'].get('mean'), old['store'].get('mean'))
+        check('%s tracks query mean' % size,
+              stats['query'].get('mean'), old['query'].get('mean'))
+        check('%s tracks accuracy' % size,
+              stats['accuracy'], old['accuracy'], accuracy=True)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Benchmark fingerprinting stages and QfpDB')
+    parser.add_argument('--sizes', default='10,50',
+                        help='comma separated catalog sizes (tracks)')
+    parser.add_argument('--seconds', type=float, default=60,
+                        help='length of the synthetic audio')
+    parser.add_argument('--queries', type=int, default=30,
+                        help='query clips per catalog')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per stage, the best time is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-db', action='store_true',
+                        help='only benchmark the fingerprinting stages')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the catalogs in the compact format')
+    parser.add_argument('--output', help='write results JSON to this file')
+    parser.add_argument('--baseline', help='results JSON to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown before a regression')
+    args = parser.parse_args(argv)
+
+    sizes = sorted(int(s) for s in args.sizes.split(','))
+    results = {'meta': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'machine': platform.machine(),
+                        'seconds': args.seconds, 'sizes': sizes,
+                        'queries': args.queries, 'seed': args.seed,
+                        'compact': args.compact}}
+    results['stages'] = bench_stages(args.seconds, args.repeat, args.seed)
+    for signal, stages in sorted(results['stages'].items()):
+        for stage in STAGES:
+            stats = stages[stage]
+            print("%-6s %-14s %8.4fs %8.1fx realtime %8.1f MiB" % (
+                signal, stage, stats['seconds'], stats['throughput'] or 0,
+                stats['peak_mb']))
+    if not args.skip_db:
+        results['catalogs'] = bench_db(sizes, args.seconds, args.queries,
+                                       args.seed, compact=args.compact)
+        for size, stats in sorted(results['catalogs'].items(),
+                                  key=lambda kv: int(kv[0])):
+            print("%5s tracks: store %.1f tracks/s, query %.1f ms mean "
+                  "(p90 %.1f ms), accuracy %.2f, %.1f MiB" % (
+                      size, stats['store']['per_second'],
+                      stats['query']['mean'] * 1000,
+                      stats['query']['p90'] * 1000, stats['accuracy'],
+                      stats['db_mb']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("%-36s %12s %12s %8s" % ('', 'baseline', 'current', 'ratio'))
+        print('\n'.join(lines))
+        if regressions:
+            print("regressions: %s" % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
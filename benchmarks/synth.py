@@ -0,0 +1,86 @@
+from __future__ import division
+import numpy as np
+
+"""
+Deterministic synthetic audio for the benchmarks. Every generator takes
+a seed and returns mono int16 samples at SAMPLE_RATE, which load_audio
+and the fingerprints accept as is.
+"""
+
+SAMPLE_RATE = 8000
+
+
+def track(seconds, seed, period=4.0):
+    """
+    Returns a music-like track: a bar of period seconds of random notes
+    with harmonics, looped for the whole track, plus light noise.
+    Repetition gives quads matching at several offsets, like real
+    music does.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(period * SAMPLE_RATE)
+    t = np.arange(n) / SAMPLE_RATE
+    bar = np.zeros(n)
+    pos = 0
+    while pos < n:
+        dur = min(int(rng.uniform(0.1, 0.4) * SAMPLE_RATE), n - pos)
+        f = rng.uniform(200, 3000)
+        env = np.hanning(dur)
+        for harmonic in (1, 2, 3):
+            if f * harmonic < SAMPLE_RATE / 2:
+                bar[pos:pos + dur] += (env / harmonic *
+                                       np.sin(2 * np.pi * f * harmonic *
+                                              t[:dur]))
+        pos += dur
+    total = int(seconds * SAMPLE_RATE)
+    signal = np.tile(bar, int(np.ceil(total / n)))[:total]
+    return _to_int16(signal + 0.05 * rng.randn(total))
+
+
+def sweep(seconds, seed=0, f0=100, f1=3900):
+    """
+    Returns a logarithmic sine sweep from f0 to f1 Hz, starting at a
+    seeded phase
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    k = np.log(f1 / f0) / seconds
+    phase = 2 * np.pi * f0 * (np.exp(k * t) - 1) / k
+    return _to_int16(np.sin(phase + rng.uniform(0, 2 * np.pi)))
+
+
+def noise(seconds, seed=0):
+    """
+    Returns white noise
+    """
+    rng = np.random.RandomState(seed)
+    return _to_int16(rng.randn(int(seconds * SAMPLE_RATE)))
+
+
+def change_speed(samples, factor):
+    """
+    Returns samples played factor times faster by linear interpolation,
+    which shifts pitch and tempo together like a turntable
+    """
+    n = int(len(samples) / factor)
+    signal = np.interp(np.arange(n) * factor, np.arange(len(samples)),
+                       samples)
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def add_noise(samples, snr, seed=0):
+    """
+    Returns samples with white noise added at snr dB
+    """
+    rng = np.random.RandomState(seed)
+    power = np.mean(np.square(samples, dtype=np.float64))
+    scale = np.sqrt(power / 10 ** (snr / 10))
+    signal = samples + rng.randn(len(samples)) * scale
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def _to_int16(signal, peak=20000):
+    """
+    Scales signal to a peak amplitude of peak
+    """
+    return (signal / np.abs(signal).max() * peak).astype(np.int16)
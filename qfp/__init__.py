@@ -1,2 +1,2 @@
 from .fingerprint import ReferenceFingerprint, QueryFingerprint
-# from .storage import Storage
\ No newline at end of file
+from .storage import Storage
\ No newline at end of file
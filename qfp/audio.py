@@ -1,42 +1,188 @@
-from pydub import AudioSegment
+from __future__ import division
+import numpy as np
+import os
+import struct
+import subprocess
+import tempfile
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
-def load_audio(path, downsample=True, normalize=False, target_dBFS=-20.0, snip=None):
+
+class DecodeError(IOError):
+    """
+    Raised when ffmpeg can not decode the audio it is given
     """
-    Creates array of samples from input audio file
+
+
+def load_audio(source, downsample=True, normalize=False, target_dBFS=-20.0,
+               snip=None, sampleRate=8000):
+    """
+    Creates array of 16-bit samples from an audio source, which is
+    either the path of an audio file, its contents (bytes or a file
+    object), or an array of raw PCM samples that is used as is.
+    PCM WAV files that need no conversion are memory-mapped, anything
+    else is decoded by ffmpeg to mono sampleRate samples (native rate
+    and channels if not downsample) through a pipe.
     snip = only return first n seconds of input
+    Raises DecodeError if ffmpeg can not decode the source.
+    Returns: int16 numpy array, read-only unless it was given
     """
-    audio = AudioSegment.from_file(path)
-    if downsample:
-        # if stereo, sample rate > 8kHz, or > 16-bit depth
-        if (audio.channels > 1) \
-                or (audio.frame_rate != 8000) \
-                or (audio.sample_width != 2):
-            audio = _downsample(audio)
-    if normalize and audio.dBFS is not target_dBFS:
-        audio = _normalize(audio, target_dBFS)
-    """if snip > audio.duration_seconds:
-        raise InvalidAudioLength(
-            "Provided snip length is longer than audio file")"""
+    if isinstance(source, np.ndarray):
+        samples = source.astype(np.int16, copy=False)
+        rate, channels = sampleRate, 1
+    else:
+        if hasattr(source, 'read'):
+            source = source.read()
+        samples, rate, channels = _read_wav(source, sampleRate, downsample)
+        if samples is None:
+            # downsampled audio is normalized by the loudness of all of
+            # it before snipping, native audio is snipped by ffmpeg
+            if downsample:
+                rate, channels = sampleRate, 1
+            samples = _decode(source, sampleRate, downsample,
+                              None if normalize and downsample else snip)
+    if normalize:
+        samples = _normalize(samples, target_dBFS)
+    if snip is not None and rate is not None:
+        samples = samples[:int(snip * rate) * channels]
+    return samples
+
+
+def _read_wav(source, sampleRate, downsample=True):
+    """
+    Maps the samples of a 16-bit PCM WAV file (path or bytes) that is
+    already mono at sampleRate, or of any 16-bit PCM WAV file if not
+    downsample.
+    Returns: (int16 samples, sample rate, channels), or Nones if the
+    source has to be decoded
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        buf = np.frombuffer(source, dtype=np.uint8)
+    else:
+        try:
+            buf = np.memmap(source, dtype=np.uint8, mode='r')
+        except ValueError:  # empty file
+            return None, None, None
+    layout = _wav_layout(buf)
+    if layout is None:
+        return None, None, None
+    channels, rate, width, offset, size = layout
+    if width != 2 or (downsample and (channels, rate) != (1, sampleRate)):
+        return None, None, None
+    size = min(size, len(buf) - offset) // 2 * 2
+    return np.asarray(buf[offset:offset + size]).view('<i2'), rate, channels
+
+
+def _wav_layout(buf):
+    """
+    Walks the RIFF chunks of a WAV file in uint8 array buf
+    Returns: (channels, sample rate, sample width, data offset, data
+    size) of PCM WAV files, otherwise None
+    """
+    if buf[:4].tobytes() != b'RIFF' or buf[8:12].tobytes() != b'WAVE':
+        return None
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(buf):
+        chunkId = buf[pos:pos + 4].tobytes()
+        size = struct.unpack('<I', buf[pos + 4:pos + 8].tobytes())[0]
+        if chunkId == b'fmt ' and size >= 16:
+            tag, channels, rate, _, _, bits = struct.unpack(
+                '<HHIIHH', buf[pos + 8:pos + 24].tobytes())
+            fmt = (tag, channels, rate, bits // 8)
+        elif chunkId == b'data':
+            if fmt is None or fmt[0] != 1:  # 1 = integer PCM
+                return None
+            return fmt[1:] + (pos + 8, size)
+        pos += 8 + size + (size & 1)
+    return None
+
+
+def _ffmpeg():
+    """
+    Returns the ffmpeg executable: $FFMPEG_BINARY if set, else ffmpeg
+    (or avconv) on the PATH
+    """
+    return (os.environ.get('FFMPEG_BINARY') or which('ffmpeg') or
+            which('avconv') or 'ffmpeg')
+
+
+def _ffmpeg_command(path, sampleRate, downsample=True, snip=None):
+    """
+    Returns ffmpeg command writing s16le samples of path to stdout
+    """
+    command = [_ffmpeg(), '-v', 'error', '-i', path]
     if snip is not None:
-        milliseconds = snip * 1000
-        audio = audio[:milliseconds]
-    return audio.get_array_of_samples()
+        command += ['-t', str(snip)]
+    command += ['-f', 's16le', '-acodec', 'pcm_s16le']
+    if downsample:
+        command += ['-ac', '1', '-ar', str(sampleRate)]
+    return command + ['-']
+
+
+def _decode(source, sampleRate, downsample=True, snip=None):
+    """
+    Decodes audio file path or contents with ffmpeg
+    Returns: int16 numpy array
+    """
+    data = None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data, source = bytes(source), 'pipe:0'
+    command = _ffmpeg_command(source, sampleRate, downsample, snip)
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise DecodeError("ffmpeg could not decode audio: %s"
+                          % err.decode('utf-8', 'replace').strip())
+    return np.frombuffer(out, dtype='<i2', count=len(out) // 2)
 
 
-def _downsample(audio, numChannels=1, sampleRate=8000, bitDepth=2):
+def _normalize(samples, target_dBFS):
     """
-    Returns downsampled AudioSegment
+    Normalizes loudness of samples, clipping like pydub's apply_gain
     """
-    audio = audio.set_channels(numChannels)
-    audio = audio.set_frame_rate(sampleRate)
-    audio = audio.set_sample_width(bitDepth)
-    return audio
+    rms = int(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+    if rms == 0:
+        return samples
+    change_in_dBFS = target_dBFS - 20 * np.log10(rms / 32768)
+    gained = np.floor(samples * 10 ** (change_in_dBFS / 20))
+    return np.clip(gained, -32768, 32767).astype(np.int16)
 
 
-def _normalize(audio, target_dBFS):
+def stream_audio(path, blocksize=80000, sampleRate=8000):
     """
-    Normalizes loudness of AudioSegment
+    Yields blocks of at most blocksize mono 16-bit samples (as int16
+    arrays) without decoding the whole file into memory. WAV files that
+    are already mono 16-bit at sampleRate are memory-mapped, anything
+    else is decoded and resampled by ffmpeg through a pipe.
     """
-    change_in_dBFS = target_dBFS - audio.dBFS
-    return audio.apply_gain(change_in_dBFS)
+    samples, _, _ = _read_wav(path, sampleRate)
+    if samples is not None:
+        for i in range(0, len(samples), blocksize):
+            yield samples[i:i + blocksize]
+        return
+    # a file rather than a pipe, which ffmpeg could fill while we read
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(_ffmpeg_command(path, sampleRate),
+                            stdout=subprocess.PIPE, stderr=errors)
+    try:
+        while True:
+            data = proc.stdout.read(blocksize * 2)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2')
+        if proc.wait() != 0:
+            errors.seek(0)
+            raise DecodeError(
+                "ffmpeg could not decode audio: %s"
+                % errors.read().decode('utf-8', 'replace').strip())
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:  # the consumer stopped early
+            proc.kill()
+            proc.wait()
+        errors.close()
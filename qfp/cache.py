@@ -0,0 +1,102 @@
+from __future__ import division
+from collections import OrderedDict
+import threading
+
+"""
+Size-bounded least recently used cache of query results, used by QfpDB
+to skip index and peak lookups that were resolved moments earlier (see
+QfpDB cache_size).
+"""
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of tuples of numpy arrays, holding at most
+    max_size bytes of array data and keys. Evicts the least recently
+    used entries first. Every invalidation increments generation, and
+    results looked up before it are not cached.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_many(self, keys):
+        """
+        Returns: list of the cached value of every key (None if not
+        cached), marking them as recently used
+        """
+        values = []
+        with self._lock:
+            for key in keys:
+                value = self._items.pop(key, None)
+                if value is None:
+                    self.misses += 1
+                else:
+                    self._items[key] = value
+                    self.hits += 1
+                values.append(value)
+        return values
+
+    def put_many(self, items, generation):
+        """
+        Caches (key, value) items, unless the cache was invalidated
+        since generation was read, then evicts the least recently used
+        entries above max_size
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            for key, value in items:
+                if key not in self._items:
+                    self._items[key] = value
+                    self.size += _size(key, value)
+            while self.size > self.max_size:
+                key, value = self._items.popitem(last=False)
+                self.size -= _size(key, value)
+
+    def discard(self, keys):
+        """
+        Removes the entries of keys
+        """
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                value = self._items.pop(key, None)
+                if value is not None:
+                    self.size -= _size(key, value)
+
+    def clear(self):
+        """
+        Removes all entries
+        """
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns dict of hits and misses since the cache was created,
+        and the number of entries and bytes held
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._items), 'size': self.size,
+                    'max_size': self.max_size}
+
+
+def _size(key, value):
+    """
+    Returns bytes of a cache entry, counting its arrays and bytes key
+    """
+    size = len(key) if isinstance(key, bytes) else 8
+    return size + sum(arr.nbytes for arr in value)
@@ -0,0 +1,110 @@
+from __future__ import print_function
+import argparse
+import sys
+
+from .db import QfpDB
+from .parallel import ingest
+from .sharded import ShardedQfpDB
+from .snapshot import SnapshotQfpDB
+from .storage import Storage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='qfp', description='Quad-based audio fingerprinting')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser(
+        'ingest', help='fingerprint reference audio files into a db')
+    p.add_argument('paths', nargs='*', help='audio files to store')
+    p.add_argument('--db', default='qfp.db', help='database path')
+    p.add_argument('--shards', type=int, default=None,
+                   help='use a sharded db: a directory of this many files')
+    p.add_argument('--list', dest='list_file',
+                   help='file with one audio path per line')
+    p.add_argument('--workers', type=int, default=None,
+                   help='worker processes (default: number of cpus)')
+    p.add_argument('--batch-size', type=int, default=100,
+                   help='records per transaction')
+    p.add_argument('--cache', help='directory caching fingerprints by '
+                   'audio content, reused when ingesting again')
+    p.add_argument('--compact', action='store_true', default=None,
+                   help='create the db in the compact storage format')
+    p.set_defaults(func=_ingest)
+
+    p = commands.add_parser(
+        'serve', help='identify audio clips posted over HTTP')
+    p.add_argument('--db', default='qfp.db', help='database path')
+    p.add_argument('--shards', type=int, default=None,
+                   help='use a sharded db: a directory of this many files')
+    p.add_argument('--snapshot', help='serve from this snapshot directory '
+                   'instead of the db')
+    p.add_argument('--cache-size', type=int, default=0,
+                   help='bytes of cached hash and peak lookups (default: 0)')
+    p.add_argument('--host', default='127.0.0.1', help='address to bind')
+    p.add_argument('--port', type=int, default=8000, help='port to bind')
+    p.add_argument('--socket', help='unix socket path, instead of a port')
+    p.add_argument('--workers', type=int, default=None,
+                   help='fingerprinting processes (default: number of cpus)')
+    p.add_argument('--threads', type=int, default=4,
+                   help='database lookup threads')
+    p.add_argument('--queue-size', type=int, default=64,
+                   help='clips queued per stage before rejecting new ones')
+    p.add_argument('--batch-size', type=int, default=8,
+                   help='queued clips identified together')
+    p.add_argument('--vthreshold', type=float, default=0.5,
+                   help='minimum validation score of a match')
+    p.set_defaults(func=_serve)
+
+    p = commands.add_parser(
+        'snapshot', help='export a db to a read-only snapshot directory')
+    p.add_argument('path', help='snapshot directory to write')
+    p.add_argument('--db', default='qfp.db', help='database path')
+    p.set_defaults(func=_snapshot)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+def _ingest(args):
+    paths = list(args.paths)
+    if args.list_file:
+        with open(args.list_file) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    cache = Storage(args.cache) if args.cache else None
+    ingest(_open_db(args), paths, workers=args.workers,
+           batch_size=args.batch_size, cache=cache)
+    return 0
+
+
+def _serve(args):
+    from .server import serve
+    if args.snapshot:
+        db = SnapshotQfpDB(args.snapshot, cache_size=args.cache_size)
+    else:
+        db = _open_db(args, readonly=True)
+    serve(db, args.host, args.port, args.socket,
+          workers=args.workers, threads=args.threads,
+          queue_size=args.queue_size, batch_size=args.batch_size,
+          vThreshold=args.vthreshold)
+    return 0
+
+
+def _snapshot(args):
+    SnapshotQfpDB.build(QfpDB(args.db, readonly=True), args.path)
+    return 0
+
+
+def _open_db(args, readonly=False):
+    compact = getattr(args, 'compact', None)
+    cacheSize = getattr(args, 'cache_size', 0)
+    if args.shards:
+        return ShardedQfpDB(args.db, args.shards, readonly=readonly,
+                            compact=compact, cache_size=cacheSize)
+    return QfpDB(args.db, readonly=readonly, compact=compact,
+                 cache_size=cacheSize)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
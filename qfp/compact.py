@@ -0,0 +1,154 @@
+from __future__ import division
+import itertools
+import numpy as np
+
+from .utils import as_peaks, as_quads
+
+"""
+Encoding of the compact QfpDB format. Instead of an R-tree box per hash
+and a row of ten integers per quad, a compact db stores every quad once,
+keyed by its hash packed into one integer: the first three dimensions
+quantized to the cells of a coarse grid and the last one to 16 bits. An
+epsilon search reads one range of keys per grid cell overlapping the
+search box, then recomputes the exact float32 hashes from the decoded
+quads, so it finds the same quads as the R-tree.
+
+    quad   Ax (int32), Ay, Cx-Ax, Cy, Dx-Ax, Dy, Bx-Ax, By (7 x int16)
+    peaks  per record: X deltas, then Y, each as uint16 or uint32
+"""
+
+CELL = 0.02
+SIZE = int(np.ceil(1 / CELL)) + 1
+FINE = 1 << 16
+QUAD = np.dtype([('ax', '<i4'), ('rest', '<i2', (7,))])
+WIDTHS = {b'H': np.dtype('<u2'), b'I': np.dtype('<u4')}
+
+
+def hash_keys(hashes):
+    """
+    Returns int64 keys of (N,4) hashes
+    """
+    hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+    return _cell_keys(_cells(hashes[:, :3])) * FINE + _fine(hashes[:, 3])
+
+
+def key_ranges(hashes, e):
+    """
+    Returns: (index of hash, first key) of the key ranges that hold the
+    keys of all hashes within e of hashes. Every range spans
+    range_width(e) keys.
+    """
+    hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+    lo, hi = _cells(hashes[:, :3] - e), _cells(hashes[:, :3] + e)
+    span = int((hi - lo).max()) + 1 if len(hashes) else 1
+    steps = np.array(list(itertools.product(range(span), repeat=3)))
+    boxes = lo[:, None, :] + steps[None, :, :]
+    inside = np.all(boxes <= hi[:, None, :], axis=2)
+    idx = np.nonzero(inside)[0]
+    first = _cell_keys(boxes[inside]) * FINE + _fine(hashes[idx, 3] - e)
+    return idx, first
+
+
+def range_width(e):
+    """
+    Returns the number of keys after the first key of a range that may
+    hold hashes within e
+    """
+    return int(np.ceil(2 * e * FINE)) + 1
+
+
+def _cells(points):
+    """
+    Returns grid cell coordinates of points, clipped to the grid
+    """
+    cells = np.floor(np.asarray(points, dtype=np.float64) / CELL)
+    return np.clip(cells, 0, SIZE - 1).astype(np.int64)
+
+
+def _cell_keys(cells):
+    """
+    Packs (N,3) cell coordinates into int64 keys
+    """
+    return (cells[:, 0] * SIZE + cells[:, 1]) * SIZE + cells[:, 2]
+
+
+def _fine(values):
+    """
+    Returns values in [0, 1] quantized to 16 bits
+    """
+    fine = np.floor(np.asarray(values, dtype=np.float64) * FINE)
+    return np.clip(fine, 0, FINE - 1).astype(np.int64)
+
+
+def encode_quads(quads):
+    """
+    Returns list of the QUAD encoded bytes of every quad
+    """
+    quads = np.asarray(quads, dtype=np.int64).reshape(-1, 8)
+    rest = quads[:, 1:].copy()
+    rest[:, 1::2] -= quads[:, [0]]
+    if len(rest) and (rest.min() < -2 ** 15 or rest.max() >= 2 ** 15):
+        raise ValueError("Quad too large for the compact format")
+    encoded = np.empty(len(quads), dtype=QUAD)
+    encoded['ax'] = quads[:, 0]
+    encoded['rest'] = rest
+    return np.frombuffer(encoded.tobytes(), dtype='V%d' % QUAD.itemsize
+                         ).tolist()
+
+
+def decode_quads(blobs):
+    """
+    Returns: (M,8) QuadArray of a sequence of encoded quads
+    """
+    encoded = np.frombuffer(b''.join(blobs), dtype=QUAD)
+    quads = np.empty((len(encoded), 8), dtype=np.int32)
+    quads[:, 0] = encoded['ax']
+    quads[:, 1:] = encoded['rest']
+    quads[:, 2::2] += quads[:, [0]]
+    return as_quads(quads)
+
+
+def encode_peaks(peaks):
+    """
+    Returns peaks sorted by X as delta encoded bytes
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+    peaks = peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+    dX = np.diff(peaks[:, 0], prepend=0)
+    columns = [_narrowest(dX), _narrowest(peaks[:, 1])]
+    return (b''.join(code for code, _ in columns) +
+            b''.join(values.tobytes() for _, values in columns))
+
+
+def decode_peaks(blob):
+    """
+    Returns: (N,2) PeakArray of encoded peaks, sorted by X
+    """
+    xWidth, yWidth = WIDTHS[blob[0:1]], WIDTHS[blob[1:2]]
+    n = count_peaks(blob[:2], len(blob))
+    dX = np.frombuffer(blob, dtype=xWidth, count=n, offset=2)
+    y = np.frombuffer(blob, dtype=yWidth, count=n,
+                      offset=2 + n * xWidth.itemsize)
+    peaks = np.empty((n, 2), dtype=np.int32)
+    np.cumsum(dX, out=peaks[:, 0])
+    peaks[:, 1] = y
+    return as_peaks(peaks)
+
+
+def count_peaks(header, length):
+    """
+    Returns number of peaks encoded in a blob of length bytes starting
+    with header (its first 2 bytes), without reading the rest of it
+    """
+    width = WIDTHS[header[0:1]].itemsize + WIDTHS[header[1:2]].itemsize
+    return (length - 2) // width
+
+
+def _narrowest(values):
+    """
+    Returns: (code, values) in the narrowest unsigned width of WIDTHS
+    """
+    if len(values) and (values.min() < 0 or values.max() >= 2 ** 32):
+        raise ValueError("Peak out of range for the compact format")
+    code = b'H' if not len(values) or values.max() < 2 ** 16 else b'I'
+    return code, values.astype(WIDTHS[code])
@@ -1,17 +1,40 @@
 from __future__ import division, print_function
-from bisect import bisect_left, bisect_right
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from qfp import stats as qstats
+from qfp.cache import LRUCache
+from qfp.compact import hash_keys, encode_quads, encode_peaks, decode_peaks
 from qfp.fingerprint import fpType
+from qfp.index import RTreeIndex, CompactIndex
+from qfp.quads import find_quads
+from qfp.utils import (as_peaks, as_quads, as_hashes, expand_ranges,
+                       generate_hash, num_partitions, strength_ranks)
+from timeit import default_timer as timer
+import itertools
 import numpy as np
+import os
 import sqlite3
-import math
-import operator
+import threading
+import time
 
 try:
     from itertools import izip
 except:
     izip = zip
 
+# connection settings used while bulk loading with QfpDB.store_many
+INGEST_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -262144,  # negative values are KiB (256 MiB)
+}
+
+# connection settings of the long-lived per-thread connections
+QUERY_PRAGMAS = {
+    'mmap_size': 1 << 30,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+
 
 class QfpDB:
     """
@@ -19,12 +42,113 @@ class QfpDB:
     querying the database with query fingerprints
     """
 
-    def __init__(self, db_path='qfp.db'):
+    def __init__(self, db_path='qfp.db', index=None, readonly=False,
+                 pragmas=None, compact=None, immutable=False, cache_size=0):
+        """
+        index is the backend used for hash lookups. Defaults to the
+        Hashes R-tree, or the CompactIndex of a compact db; see
+        qfp.index for alternatives.
+
+        compact=True creates a db in the compact format of qfp.compact,
+        several times smaller than the default R-tree format. An
+        existing db is opened in the format it was created with.
+
+        Every thread using the QfpDB gets its own long-lived connection,
+        configured with QUERY_PRAGMAS updated by pragmas. A readonly
+        QfpDB opens the database read-only and does not create tables.
+        An immutable QfpDB is readonly and also tells SQLite that the
+        file can not change, so it is read without any locking. It must
+        not be written to while open, and changes still in its WAL file
+        are not seen (compact() checkpoints them). Use close() (or a
+        with block) to close all connections. Many query processes can
+        share a snapshot of the db instead, see qfp.snapshot.
+
+        cache_size > 0 keeps the index lookups of recent query hashes,
+        and the peaks of recently validated records, in LRU caches of
+        up to cache_size bytes each. They are invalidated by writes
+        through this QfpDB, not by other processes writing to the db.
+        See cache_stats().
+        """
         self.path = db_path
-        with sqlite3.connect(self.path) as conn:
+        self.readonly = readonly or immutable
+        self.immutable = immutable
+        self.pragmas = dict(QUERY_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0
+        self.hash_cache = LRUCache(cache_size)
+        self.peak_cache = LRUCache(cache_size)
+        self.compact_format = self._stored_format(compact)
+        if index is None:
+            if self.compact_format:
+                index = CompactIndex(self)
+            else:
+                index = RTreeIndex(self)
+        self.index = index
+        if not self.readonly:
+            conn = self.connection()
+            # only takes effect in a new db, see compact()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
             self._create_tables(conn)
         self._create_named_tuples()
-        conn.close()
+
+    def connection(self):
+        """
+        Returns the calling thread's connection to the db, opening it on
+        first use
+        """
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            if self.readonly:
+                uri = 'file:%s?mode=ro' % os.path.abspath(self.path)
+                if self.immutable:
+                    uri += '&immutable=1'
+                conn = sqlite3.connect(uri, uri=True,
+                                       check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+            for pragma, value in self.pragmas.items():
+                conn.execute("PRAGMA %s = %s" % (pragma, value))
+            with self._lock:
+                self._connections.append(conn)
+                local.conn, local.generation = conn, self._generation
+        return local.conn
+
+    def close(self):
+        """
+        Closes the connections of all threads. They are reopened when
+        the QfpDB is used again.
+        """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._generation += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _stored_format(self, compact):
+        """
+        Returns True if the db is (to be) stored in the compact format
+        """
+        c = self.connection().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = set(name for name, in c)
+        c.close()
+        if 'Records' not in tables:
+            return bool(compact)
+        stored = 'CompactQuads' in tables
+        if compact is not None and bool(compact) != stored:
+            raise ValueError("%s is %sa compact db"
+                             % (self.path, '' if stored else 'not '))
+        return stored
 
     def _create_tables(self, conn):
         """
@@ -32,6 +156,30 @@ class QfpDB:
         in database. executescript will automatically commit
         these changes.
         """
+        if self.compact_format:
+            conn.executescript("""
+                CREATE TABLE
+                IF NOT EXISTS Records(
+                    id INTEGER PRIMARY KEY,
+                    title TEXT);
+                CREATE TABLE
+                IF NOT EXISTS CompactQuads(
+                    hashkey INTEGER, recordid INTEGER, quadid INTEGER,
+                    quad BLOB,
+                    PRIMARY KEY(hashkey, recordid, quadid),
+                    FOREIGN KEY(recordid) REFERENCES Records(id))
+                WITHOUT ROWID;
+                CREATE TABLE
+                IF NOT EXISTS CompactPeaks(
+                    recordid INTEGER PRIMARY KEY,
+                    peaks BLOB,
+                    FOREIGN KEY(recordid) REFERENCES Records(id));
+                CREATE INDEX
+                IF NOT EXISTS RecordTitles ON Records(title);
+                CREATE INDEX
+                IF NOT EXISTS CompactQuadRecords
+                ON CompactQuads(recordid);""")
+            return
         conn.executescript("""
             CREATE VIRTUAL TABLE
             IF NOT EXISTS Hashes USING rtree(
@@ -58,14 +206,18 @@ class QfpDB:
             IF NOT EXISTS Peaks(
                 recordid INTEGER, X INTEGER, Y INTEGER,
                 PRIMARY KEY(recordid, X, Y),
-                FOREIGN KEY(recordid) REFERENCES Records(id));""")
+                FOREIGN KEY(recordid) REFERENCES Records(id));
+            CREATE INDEX
+            IF NOT EXISTS RecordTitles ON Records(title);
+            CREATE INDEX
+            IF NOT EXISTS QuadRecords ON Quads(recordid);""")
 
     def _create_named_tuples(self):
-        self.Peak = namedtuple('Peak', ['x', 'y'])
-        self.Quad = namedtuple('Quad', ['A', 'C', 'D', 'B'])
         mcNames = ['recordid', 'offset', 'num_matches', 'sTime', 'sFreq']
         self.MatchCandidate = namedtuple('MatchCandidate', mcNames)
         self.Match = namedtuple('Match', ['record', 'offset', 'vScore'])
+        self.TimedMatch = namedtuple('TimedMatch', self.Match._fields +
+                                     ('latency',))
 
     """
     STORING FINGERPRINTS
@@ -77,32 +229,159 @@ class QfpDB:
         """
         if fp.fp_type != fpType.Reference:
             raise TypeError("May only store reference fingerprints in db")
-        with sqlite3.connect(self.path) as conn:
+        conn = self.connection()
+        with conn:
             c = conn.cursor()
+            hashid = self._begin_write(c)
             if not self._record_exists(c, title):
-                recordid = self._store_record(c, title)
-                self._store_peaks(c, fp, recordid)
-                for qHash, qQuad in izip(fp.hashes, fp.strongest):
-                    self._store_hash(c, qHash)
-                    self._store_quad(c, qQuad, recordid)
-        conn.commit()
-        conn.close()
+                self._store_fingerprint(c, fp, title, hashid)
+            c.close()
+        self.hash_cache.clear()
+
+    def store_many(self, fps, batch_size=100, pragmas=None):
+        """
+        Bulk-stores an iterable of (reference fingerprint, title) pairs.
+        Hash ids are assigned at the start of every batch and every
+        table is loaded with executemany, committing once per batch_size
+        records. pragmas
+        overrides the connection settings in INGEST_PRAGMAS.
+        Returns: number of records stored per second
+        """
+        settings = dict(INGEST_PRAGMAS)
+        settings.update(pragmas or {})
+        stored = 0
+        start = time.time()
+        conn = self.connection()
+        previous = self._set_pragmas(conn, settings)
+        c = conn.cursor()
+        try:
+            hashid = None
+            pending = 0
+            for fp, title in fps:
+                if fp.fp_type != fpType.Reference:
+                    raise TypeError(
+                        "May only store reference fingerprints in db")
+                if hashid is None:
+                    hashid = self._begin_write(c)
+                if self._record_exists(c, title):
+                    continue
+                hashid = self._store_fingerprint(c, fp, title, hashid)
+                pending += 1
+                if pending == batch_size:
+                    conn.commit()
+                    hashid = None
+                    self.hash_cache.clear()
+                    stored += pending
+                    pending = 0
+                    print("stored %d records (%.1f tracks/s)" %
+                          (stored, stored / (time.time() - start)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+            self._set_pragmas(conn, previous)
+            self.hash_cache.clear()
+        stored += pending
+        rate = stored / max(time.time() - start, 1e-9)
+        if pending:
+            print("stored %d records (%.1f tracks/s)" % (stored, rate))
+        return rate
+
+    def _set_pragmas(self, conn, settings):
+        """
+        Applies PRAGMA settings to conn
+        Returns: dictionary of the previous settings
+        """
+        previous = {}
+        for pragma, value in settings.items():
+            previous[pragma] = conn.execute("PRAGMA %s" % pragma).fetchone()[0]
+            conn.execute("PRAGMA %s = %s" % (pragma, value))
+        return previous
+
+    def _begin_write(self, c):
+        """
+        Starts a transaction holding the db's write lock, so that no
+        other connection can take the hash ids read under it
+        Returns: first unused hashid
+        """
+        c.execute("BEGIN IMMEDIATE")
+        return self._next_hashid(c)
+
+    def _next_hashid(self, c):
+        """
+        Returns the first unused id of the Hashes table (0 in a compact
+        db, which has none)
+        """
+        if self.compact_format:
+            return 0
+        c.execute("SELECT IFNULL(MAX(id), 0) + 1 FROM Hashes")
+        return c.fetchone()[0]
+
+    def _store_fingerprint(self, c, fp, title, hashid):
+        """
+        Stores record, peaks, hashes and quads of a reference
+        fingerprint. Hashes are numbered consecutively from hashid.
+        Returns: next unused hashid
+        """
+        recordid = self._store_record(c, title)
+        if self.compact_format:
+            self._store_compact(c, fp, recordid)
+            return hashid
+        hashes = np.asarray(fp.hashes, dtype=np.float64).reshape(-1, 4)
+        quads = np.asarray(fp.strongest, dtype=np.int64).reshape(-1, 8)
+        hashids = np.arange(hashid, hashid + len(hashes), dtype=np.int64)
+        self._store_peaks(c, fp, recordid)
+        self._store_hashes(c, hashids, hashes)
+        self._store_quads(c, hashids, quads, recordid)
+        return hashid + len(hashes)
+
+    def _store_compact(self, c, fp, recordid):
+        """
+        Stores the quads of a reference fingerprint keyed by their
+        packed hash, and its delta encoded peaks
+        """
+        quads = np.asarray(fp.strongest, dtype=np.int64).reshape(-1, 8)
+        keys = hash_keys(generate_hash(quads))
+        c.executemany("""INSERT INTO CompactQuads
+                         VALUES (?,?,?,?)""",
+                      izip(keys.tolist(), itertools.repeat(recordid),
+                           range(len(quads)),
+                           map(sqlite3.Binary, encode_quads(quads))))
+        c.execute("""INSERT INTO CompactPeaks
+                     VALUES (?,?)""",
+                  (recordid, sqlite3.Binary(encode_peaks(fp.peaks))))
+
+    def titles(self):
+        """
+        Returns set of all record titles stored in the QfpDB
+        """
+        c = self.connection().execute("SELECT title FROM Records")
+        titles = set(t for t, in c)
+        c.close()
+        return titles
 
     def _record_exists(self, c, title):
         """
         Returns True/False depending on existence of a song title
         in the QfpDB
         """
-        c.execute("""SELECT id
-                       FROM Records
-                      WHERE title = ?""", (title,))
-        recordid = c.fetchone()
-        if recordid is None:
+        if not self._lookup_recordids(c, title):
             return False
         else:
             print("record already exists...")
             return True
 
+    def _lookup_recordids(self, c, title):
+        """
+        Returns list of the ids of the records titled title
+        """
+        c.execute("""SELECT id
+                       FROM Records
+                      WHERE title = ?""", (title,))
+        return [recordid for recordid, in c.fetchall()]
+
     def _store_record(self, c, title):
         """
         Inserts a song title into the Records table, then
@@ -116,215 +395,666 @@ class QfpDB:
         """
         Stores peaks from reference fingerprint
         """
-        for x, y in fp.peaks:
-            c.execute("""INSERT INTO Peaks
-                         VALUES (?,?,?)""", (recordid, x, y))
+        peaks = np.asarray(fp.peaks, dtype=np.int64).reshape(-1, 2)
+        rows = np.empty((len(peaks), 3), dtype=np.int64)
+        rows[:, 0] = recordid
+        rows[:, 1:] = peaks
+        c.executemany("""INSERT INTO Peaks
+                         VALUES (?,?,?)""", rows.tolist())
 
-    def _store_hash(self, c, h):
+    def _store_hashes(self, c, hashids, hashes):
         """
-        Inserts given hash into QfpDB's Hashes table
+        Inserts given hashes into QfpDB's Hashes table as degenerate
+        boxes (min == max in every dimension)
         """
-        c.execute("""INSERT INTO Hashes
-                     VALUES (null,?,?,?,?,?,?,?,?)""",
-                  (h[0], h[0], h[1], h[1], h[2], h[2], h[3], h[3]))
+        bounds = np.repeat(hashes, 2, axis=1).T.tolist()
+        c.executemany("""INSERT INTO Hashes
+                         VALUES (?,?,?,?,?,?,?,?,?)""",
+                      izip(hashids.tolist(), *bounds))
 
-    def _store_quad(self, c, q, recordid):
+    def _store_quads(self, c, hashids, quads, recordid):
         """
-        Inserts given quad into the Quads table
+        Inserts given quads into the Quads table
         """
-        hashid = c.lastrowid
-        values = (hashid, recordid, q.A.x, q.A.y, q.C.x, q.C.y,
-                  q.D.x, q.D.y, q.B.x, q.B.y)
-        c.execute("""INSERT INTO Quads
-                     VALUES (?,?,?,?,?,?,?,?,?,?)""", values)
+        rows = np.empty((len(quads), 10), dtype=np.int64)
+        rows[:, 0] = hashids
+        rows[:, 1] = recordid
+        rows[:, 2:] = quads
+        c.executemany("""INSERT INTO Quads
+                         VALUES (?,?,?,?,?,?,?,?,?,?)""", rows.tolist())
+
+    """
+    MAINTAINING DB
+    """
+
+    def delete(self, title):
+        """
+        Deletes the record title with its hashes, quads and peaks. The
+        rows are found through indexes on recordid, so deleting takes
+        time proportional to the size of the record.
+        Returns: True if the record was stored, False otherwise
+        """
+        conn = self.connection()
+        with conn:
+            c = conn.cursor()
+            recordids = self._lookup_recordids(c, title)
+            for recordid in recordids:
+                self._delete_record(c, recordid)
+            c.close()
+        self._invalidate(recordids)
+        return bool(recordids)
+
+    def replace(self, fp, title):
+        """
+        Stores a reference fingerprint in the db in place of the record
+        title (if any), in a single transaction
+        """
+        if fp.fp_type != fpType.Reference:
+            raise TypeError("May only store reference fingerprints in db")
+        conn = self.connection()
+        with conn:
+            c = conn.cursor()
+            self._begin_write(c)
+            recordids = self._lookup_recordids(c, title)
+            for recordid in recordids:
+                self._delete_record(c, recordid)
+            self._store_fingerprint(c, fp, title, self._next_hashid(c))
+            c.close()
+        self._invalidate(recordids)
+
+    def compact(self):
+        """
+        Returns the pages freed by deleted records to the file system.
+        New dbs use incremental auto_vacuum, so only the free pages are
+        moved while readers carry on with their snapshot of the WAL.
+        Older dbs are vacuumed once, which rewrites the whole file, and
+        switched to incremental auto_vacuum. The R-tree rebalances on
+        every delete; a GridIndex must be rebuilt after deleting.
+        """
+        conn = self.connection()
+        conn.commit()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # unlike execute, executescript steps it until all are freed
+            conn.executescript("PRAGMA incremental_vacuum")
+        else:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def _delete_record(self, c, recordid):
+        """
+        Deletes a record and all rows referencing it
+        """
+        if self.compact_format:
+            c.execute("""DELETE FROM CompactQuads
+                          WHERE recordid = ?""", (recordid,))
+            c.execute("""DELETE FROM CompactPeaks
+                          WHERE recordid = ?""", (recordid,))
+        else:
+            c.execute("""DELETE FROM Hashes
+                          WHERE id IN (SELECT hashid
+                                         FROM Quads
+                                        WHERE recordid = ?)""",
+                      (recordid,))
+            c.execute("""DELETE FROM Quads
+                          WHERE recordid = ?""", (recordid,))
+            c.execute("""DELETE FROM Peaks
+                          WHERE recordid = ?""", (recordid,))
+        c.execute("""DELETE FROM Records
+                      WHERE id = ?""", (recordid,))
+
+    def _invalidate(self, recordids):
+        """
+        Drops the cached lookups made stale by deleting recordids (whose
+        ids a new record may reuse)
+        """
+        self.hash_cache.clear()
+        self.peak_cache.discard(recordids)
 
     """
     QUERYING DB
     """
 
-    def query(self, fp, vThreshold=0.5):
+    def cache_stats(self):
+        """
+        Returns dict of the hits, misses, entries and bytes of the hash
+        and peak caches (see cache_size)
+        """
+        return {'hashes': self.hash_cache.stats(),
+                'peaks': self.peak_cache.stats()}
+
+    def query(self, fp, vThreshold=0.5, margin=None):
+        """
+        Queries database for a given query fingerprint. Match candidates
+        are validated in order of their number of matching quads. If
+        margin is given, validation stops early once a candidate scores
+        at least vThreshold + margin.
         """
-        Queries database for a given query fingerprint
+        self.query_many([fp], vThreshold, margin)
+
+    def query_many(self, fps, vThreshold=0.5, margin=None):
+        """
+        Queries database for many query fingerprints in one pass. Hashes
+        shared by several fingerprints are looked up once, and the peaks
+        of the match candidates of all fingerprints are fetched together.
+        Sets match_candidates and matches of every fingerprint exactly
+        like query does. With qfp.stats enabled, query_stats of every
+        fingerprint is set to the Stats of the whole batch.
+        Returns: list of the matches of each fingerprint
+        """
+        fps = list(fps)
+        for fp in fps:
+            if fp.fp_type != fpType.Query:
+                raise TypeError("May only query db with query fingerprints")
+        stats = qstats.new('query')
+        candidates = self._find_match_candidates(fps, stats)
+        for fp, mcs in izip(fps, candidates):
+            fp.match_candidates = mcs
+        with stats.time('validate'):
+            matches = self._validate_matches(fps, vThreshold, margin,
+                                             stats=stats)
+        stats.count('fingerprints', len(fps))
+        stats.count('matches', sum(len(m) for m in matches))
+        stats = qstats.finish(stats)
+        for fp, fpMatches in izip(fps, matches):
+            fp.matches = fpMatches
+            fp.query_stats = stats
+        return matches
+
+    def query_top(self, fp, k=1, vThreshold=0.5, margin=0.0, budget=None,
+                  chunk=256):
+        """
+        Low-latency query for the k best matching records. Hashes are
+        looked up chunk at a time in order of strength (the strongest
+        quad of every second, then the second strongest...). After each
+        chunk the candidates are ranked by all pairs found so far, and
+        the k leading candidates not yet validated are validated right
+        away. Once every hash is looked up, the remaining candidates
+        are validated k at a time. Stops as soon as k records score at
+        least vThreshold + margin, or once budget seconds have passed.
+        Sets match_candidates and matches like query, matches being
+        TimedMatches: Matches with the latency (seconds since the query
+        started) at which they were found.
+        Returns: up to k TimedMatches scoring at least vThreshold, best
+        first
         """
         if fp.fp_type != fpType.Query:
             raise TypeError("May only query db with query fingerprints")
-        fp.match_candidates = self._find_match_candidates(fp)
-        conn = sqlite3.connect(self.path)
-        c = conn.cursor()
-        fp.matches = [m for m in [self._validate_match(fp, c, mc) for mc in fp.match_candidates] if m.vScore >= vThreshold]
-        c.close()
-        conn.close()
+        start = timer()
+        stats = qstats.new('query')
+        order = np.argsort(self._strength_ranks(fp), kind='mergesort')
+        quads = as_quads(fp.strongest)[order]
+        hashes = as_hashes(fp.hashes)[order]
+        pairs, candidates, validated, best = [], [], set(), {}
+        i = 0
+        while True:
+            if i < len(order):
+                pairs.append(self._match_pairs(
+                    [quads[i:i + chunk]], [hashes[i:i + chunk]], stats))
+                # most matching quads first, as _validate_matches ranks them
+                candidates = sorted(self._bin_candidates(pairs, 1, stats)[0],
+                                    key=lambda mc: mc.num_matches,
+                                    reverse=True)
+                i += chunk
+            leading = [mc for mc in candidates
+                       if (mc.recordid, mc.offset) not in validated][:k]
+            if not leading and i >= len(order):
+                break
+            if leading:
+                with stats.time('validate'):
+                    vScores = self._verify_peaks(
+                        leading, self._candidate_peaks(leading), fp.peaks)
+                stats.count('validated', len(leading))
+                for mc, vScore in izip(leading, vScores.tolist()):
+                    validated.add((mc.recordid, mc.offset))
+                    if vScore < vThreshold:
+                        continue
+                    record = self._record_title(mc.recordid)
+                    if record is None:
+                        continue  # deleted since the index was built
+                    if record not in best or vScore > best[record].vScore:
+                        best[record] = self.TimedMatch(
+                            record, mc.offset, vScore, timer() - start)
+            confident = [m for m in best.values()
+                         if m.vScore >= vThreshold + margin]
+            if len(confident) >= k or (
+                    budget is not None and timer() - start >= budget):
+                break
+        stats.count('hashes_used', min(i, len(order)))
+        fp.match_candidates = candidates
+        fp.matches = sorted(best.values(), key=lambda m: m.vScore,
+                            reverse=True)[:k]
+        fp.query_stats = qstats.finish(stats)
+        return fp.matches
 
-    def _find_match_candidates(self, fp):
+    def _strength_ranks(self, fp):
+        """
+        Returns the strength ranks of the strongest quads of fp. Without
+        fp.ranks (e.g. restored from a cache), the number of partitions
+        they were selected from is found by finding the quads again.
+        """
+        if fp.ranks is not None and len(fp.ranks) == len(fp.strongest):
+            return fp.ranks
+        q, r, c, w, h = fp.params
+        quads = find_quads(as_peaks(fp.peaks), r, c)
+        return strength_ranks(fp.strongest, num_partitions(quads))
+
+    def _find_match_candidates(self, fps, stats=qstats.NULL_STATS):
         """
         Searches the db for matching hashes, then checks if the matching
         quad is within scale bounds. A histogram of these matches that are
         within scale bounds is created. If the offset (rough point in time in
         the song) receives 4 or more matches, it is considered a true match
         candidate.
+        Returns: list of MatchCandidates of each fingerprint
         """
-        conn = sqlite3.connect(self.path)
-        c = conn.cursor()
-        filtered = defaultdict(list)
-        for qHash, qQuad in izip(fp.hashes, fp.strongest):
-            self._radius_nn(c, qHash)
-            with np.errstate(divide='ignore', invalid='ignore'):
-                self._filter_candidates(conn, c, qQuad, filtered)
-        binned = {k: self._bin_times(v) for k, v in filtered.items()}
-        results = {k: self._scales(v)
-                   for k, v in binned.items() if len(v) >= 4}
-        mc = [self.MatchCandidate(k, a[0], a[1], a[2][0], a[2][1])
-              for k, v in results.items() for a in v]
-        c.close()
-        conn.close()
-        return mc
-
-    def _radius_nn(self, c, h, e=0.01):
-        """
-        Epsilon (e) neighbor search for a given hash. Matching hash ids
-        can be retrieved from the cursor.
-        """
-        c.execute("""SELECT id FROM Hashes
-                      WHERE minW >= ? AND maxW <= ?
-                        AND minX >= ? AND maxX <= ?
-                        AND minY >= ? AND maxY <= ?
-                        AND minZ >= ? AND maxZ <= ?""",
-                  (h[0] - e,       h[0] + e,
-                   h[1] - e,       h[1] + e,
-                   h[2] - e,       h[2] + e,
-                   h[3] - e,       h[3] + e))
-
-    def _filter_candidates(self, conn, c, qQuad, results, e=0.2, eFine=1.8):
-        """
-        Performs three tests on potential matching quads. Quads that pass
-        these tests are added to the results dictionary.
-        """
-        for hashid in c:
-            cQuad, recordid = self._lookup_quad(conn, hashid)
-            # Rough pitch coherence:
-            #   1/(1+e) <= queAy/canAy <= 1/(1-e)
-            if not 1 / (1 + e) <= qQuad.A.y / cQuad.A.y <= 1 / (1 - e):
-                continue
-            # X transformation tolerance check:
-            #   sTime = (queBx-queAx)/(canBx-canAx)
-            sTime = (qQuad.B.x - qQuad.A.x) / (cQuad.B.x - cQuad.A.x)
-            if not 1 / (1 + e) <= sTime <= 1 / (1 - e):
-                continue
-            # Y transformation tolerance check:
-            #   sFreq = (queBy-queAy)/(canBy-canAy)
-            sFreq = (qQuad.B.y - qQuad.A.y) / (cQuad.B.y - cQuad.A.y)
-            if not 1 / (1 + e) <= sFreq <= 1 / (1 - e):
-                continue
-            # Fine pitch coherence:
-            #   |queAy-canAy*sFreq| <= eFine
-            if not abs(qQuad.A.y - (cQuad.A.y * sFreq)) <= eFine:
-                continue
-            offset = cQuad.A.x - (qQuad.A.x / sTime)
-            results[recordid].append((offset, (sTime, sFreq)))
-
-    def _lookup_quad(self, conn, hashid):
-        """
-        Returns quad and recordid of a given hashid
+        pairs = self._match_pairs([fp.strongest for fp in fps],
+                                  [fp.hashes for fp in fps], stats)
+        return self._bin_candidates([pairs], len(fps), stats)
+
+    def _match_pairs(self, quads, hashes, stats=qstats.NULL_STATS):
         """
-        c = conn.cursor()
-        c.execute("""SELECT Ax,Ay,Cx,Cy,Dx,Dy,Bx,By,recordid FROM Quads
-                      WHERE hashid=?""", hashid)
-        r = c.fetchone()
-        c.close()
-        quad = self.Quad(self.Peak(r[0], r[1]), self.Peak(r[2], r[3]),
-                         self.Peak(r[4], r[5]), self.Peak(r[6], r[7]))
-        recordid = r[8]
-        return quad, recordid
+        Looks up the hashes of a list of (quads, hashes) arrays of
+        fingerprints and filters the pairs of their quads and the quads
+        found.
+        Returns: (keys, rough offset, (sTime, sFreq)) arrays of the
+        pairs passing, keys holding (fingerprint, recordid)
+        """
+        with stats.time('lookup'):
+            qidx, recordids, cQuads = self._lookup_hashes(hashes, stats)
+        stats.count('pairs', len(qidx))
+        qQuads = np.concatenate(
+            [np.asarray(q, dtype=np.int64).reshape(-1, 8) for q in quads] +
+            [np.empty((0, 8), dtype=np.int64)])
+        sizes = [len(q) for q in quads]
+        fpids = np.repeat(np.arange(len(quads)), sizes)[qidx]
+        with stats.time('filter'), \
+                np.errstate(divide='ignore', invalid='ignore'):
+            return self._filter_candidates(
+                qQuads[qidx], cQuads, np.column_stack((fpids, recordids)),
+                stats=stats)
+
+    def _bin_candidates(self, pairs, n, stats=qstats.NULL_STATS):
+        """
+        Bins the time offsets of a list of filtered (keys, offsets,
+        scales) pairs of n fingerprints into match candidates
+        Returns: list of MatchCandidates of each fingerprint, ordered
+        by recordid, then most matching quads first (see _scales)
+        """
+        keys, offsets, scales = (np.concatenate(arrays)
+                                 for arrays in izip(*pairs))
+        with stats.time('bin'):
+            groups, scales = self._bin_times(keys, offsets, scales)
+            results = self._scales(groups, scales)
+        stats.count('binned', len(groups))
+        stats.count('candidates', len(results))
+        candidates = [[] for _ in range(n)]
+        for r in results:
+            candidates[r[0]].append(self.MatchCandidate(*r[1:]))
+        return candidates
 
-    def _bin_times(self, l, binwidth=20, ts=4):
+    def _lookup_hashes(self, hashes, stats=qstats.NULL_STATS):
         """
-        Takes list of rough offsets and bins them in time increments of
-        binwidth. These offsets are stored in a dictionary of
-        {binned time : [list of scale factors]}. Binned time keys with
-        less than Ts scale factor values are filtered out.
+        Looks up a list of hash arrays with a single index query, each
+        distinct hash only once.
+        Returns: (index into the concatenated hashes, recordid, (N,8)
+        quads) ordered by hash index
         """
-        d = defaultdict(list)
-        for rough_offset in l:
-            div = rough_offset[0] / binwidth
-            binname = int(math.floor(div) * binwidth)
-            d[binname].append((rough_offset[1][0], rough_offset[1][1]))
-        return {k: v for k, v in d.items() if len(v) >= ts}
+        hashes = np.concatenate(
+            [np.asarray(h).reshape(-1, 4) for h in hashes] +
+            [np.empty((0, 4), dtype=np.float32)])
+        if len(hashes) == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty((0, 8), dtype=np.int64))
+        unique, inverse = np.unique(hashes, axis=0, return_inverse=True)
+        uidx, recordids, cQuads = self._query_index(unique)
+        stats.count('hashes', len(hashes))
+        stats.count('unique_hashes', len(unique))
+        stats.count('index_hits', len(uidx))
+        # every hash index sharing each found unique hash
+        order = np.argsort(inverse.ravel(), kind='mergesort')
+        sortedInverse = inverse.ravel()[order]
+        starts = np.searchsorted(sortedInverse, uidx, side='left')
+        stops = np.searchsorted(sortedInverse, uidx, side='right')
+        owner, idx = expand_ranges(starts, stops)
+        qidx = order[idx]
+        byHash = np.argsort(qidx, kind='mergesort')
+        owner = owner[byHash]
+        return qidx[byHash], recordids[owner], cQuads[owner]
 
-    def _scales(self, d):
+    def _query_index(self, hashes):
         """
-        Receives dictionary of {binned time : [scale factors]}
-        Performs variance-based outlier removal on these scales. If 4 or more
-        matches remain after outliers are removed, a list with form
-        [(rough offset, num matches, scale averages)]] is created. This result
-        is sorted by # of matches in descending order and returned.
+        Returns: (index of hash, recordid, (N,8) quads) of the quads
+        whose hash is within epsilon of one of hashes. The results of
+        every hash are cached, keyed by its exact (float32) value.
         """
-        o_rm = {k: self._outlier_removal(v) for k, v in d.items()}
-        res = [(i[0], len(i[1]), np.mean(i[1], axis=0))
-               for i in o_rm.items() if len(i[1]) >= 4]
-        sorted_mc = sorted(res, key=operator.itemgetter(1), reverse=True)
-        return sorted_mc
+        if not self.hash_cache.max_size:
+            qidx, _, recordids, quads = self.index.query(hashes)
+            return qidx, recordids, quads
+        hashes = np.ascontiguousarray(hashes).reshape(-1, 4)
+        keys = hashes.view(np.dtype((np.void, hashes.itemsize * 4)))
+        keys = keys.ravel().tolist()
+        generation = self.hash_cache.generation
+        found = self.hash_cache.get_many(keys)
+        missing = [i for i, value in enumerate(found) if value is None]
+        if missing:
+            qidx, _, recordids, quads = self.index.query(hashes[missing])
+            order = np.argsort(qidx, kind='mergesort')
+            bounds = np.searchsorted(qidx[order], np.arange(len(missing) + 1))
+            for j, i in enumerate(missing):
+                rows = order[bounds[j]:bounds[j + 1]]
+                found[i] = (recordids[rows], quads[rows])
+            self.hash_cache.put_many([(keys[i], found[i]) for i in missing],
+                                     generation)
+        lengths = [len(value[0]) for value in found]
+        return (np.repeat(np.arange(len(found)), lengths),
+                np.concatenate([value[0] for value in found] +
+                               [np.empty(0, dtype=np.int64)]),
+                np.concatenate([value[1] for value in found] +
+                               [np.empty((0, 8), dtype=np.int64)]))
 
-    def _outlier_removal(self, d):
+    def _filter_candidates(self, qQuads, cQuads, keys, e=0.2, eFine=1.8,
+                           stats=qstats.NULL_STATS):
         """
-        Calculates mean/std. dev. for sTime/sFreq values,
-        then removes any outliers (defined as mean +/- 2 * stdv).
-        Returns list of final means.
+        Performs three tests on pairs of query/candidate quads (rows of
+        qQuads and cQuads). Columns are Ax,Ay,Cx,Cy,Dx,Dy,Bx,By. keys
+        holds the (fingerprint, recordid) of every pair.
+        Returns: (keys, rough offset, (sTime, sFreq)) arrays of the
+        pairs that pass these tests
         """
-        means = np.mean(d, axis=0)
-        stds = np.std(d, axis=0)
-        d = [v for v in d if
-             (means[0] - 2 * stds[0] <= v[0] <= means[0] + 2 * stds[0]) and
-             (means[1] - 2 * stds[1] <= v[1] <= means[1] + 2 * stds[1])]
-        return d
+        qAx, qAy, qBx, qBy = (qQuads[:, i] for i in (0, 1, 6, 7))
+        cAx, cAy, cBx, cBy = (cQuads[:, i] for i in (0, 1, 6, 7))
+        lo, hi = 1 / (1 + e), 1 / (1 - e)
+        # Rough pitch coherence:
+        #   1/(1+e) <= queAy/canAy <= 1/(1-e)
+        pitch = qAy / cAy
+        # X transformation tolerance check:
+        #   sTime = (queBx-queAx)/(canBx-canAx)
+        sTime = (qBx - qAx) / (cBx - cAx)
+        # Y transformation tolerance check:
+        #   sFreq = (queBy-queAy)/(canBy-canAy)
+        sFreq = (qBy - qAy) / (cBy - cAy)
+        # Fine pitch coherence:
+        #   |queAy-canAy*sFreq| <= eFine
+        mask = ((lo <= pitch) & (pitch <= hi) &
+                (lo <= sTime) & (sTime <= hi) &
+                (lo <= sFreq) & (sFreq <= hi) &
+                (np.abs(qAy - cAy * sFreq) <= eFine))
+        if stats.enabled:
+            # pairs surviving each test, in order
+            passed = (lo <= pitch) & (pitch <= hi)
+            stats.count('pass_pitch', passed.sum())
+            passed &= (lo <= sTime) & (sTime <= hi)
+            stats.count('pass_time', passed.sum())
+            passed &= (lo <= sFreq) & (sFreq <= hi)
+            stats.count('pass_freq', passed.sum())
+            stats.count('pass_fine', mask.sum())
+        offsets = cAx[mask] - qAx[mask] / sTime[mask]
+        scales = np.column_stack((sTime[mask], sFreq[mask]))
+        return keys[mask], offsets, scales
 
-    def _validate_match(self, fp, c, mc):
+    def _bin_times(self, keys, offsets, scales, binwidth=20, ts=4):
         """
+        Bins the rough offsets of each (fingerprint, record) key in time
+        increments of binwidth. Bins with less than Ts scale factor
+        values are filtered out.
+        Returns: (N,3) array of (fingerprint, recordid, binned time) and
+        the (N,2) scale factors of the matches that were kept
         """
-        rPeaks = self._lookup_peak_range(c, mc.recordid, mc.offset)
-        vScore = self._verify_peaks(mc, rPeaks, fp.peaks)
-        return self.Match(self._lookup_record(c, mc.recordid), mc.offset, vScore)
+        bins = np.floor(offsets / binwidth).astype(np.int64) * binwidth
+        groups = np.column_stack((keys, bins))
+        if len(groups) == 0:
+            return groups, scales
+        _, inverse, counts = np.unique(groups, axis=0, return_inverse=True,
+                                       return_counts=True)
+        keep = counts[inverse.ravel()] >= ts
+        return groups[keep], scales[keep]
 
-    def _lookup_peak_range(self, c, recordid, offset, e=3750):
+    def _scales(self, groups, scales, min_bins=4):
         """
-        Queries Peaks table for peaks of given recordid that are within
-        3750 samples (15s) of the estimated offset value.
+        Receives (fingerprint, recordid, binned time) of every match
+        with its scale factors. Records with less than min_bins distinct
+        bins are dropped. Performs variance-based outlier removal on the
+        scales of each bin. If 4 or more matches remain after outliers
+        are removed, a tuple (fingerprint, recordid, rough offset, num
+        matches, sTime, sFreq) is created. Results are sorted by
+        fingerprint, recordid, then # of matches in descending order.
+        """
+        if len(groups) == 0:
+            return []
+        keys, inverse = np.unique(groups, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        _, rInverse, rBins = np.unique(keys[:, :2], axis=0,
+                                       return_inverse=True,
+                                       return_counts=True)
+        keep = self._outlier_removal(inverse, scales, len(keys))
+        keep &= (rBins[rInverse.ravel()] >= min_bins)[inverse]
+        counts = np.bincount(inverse[keep], minlength=len(keys))
+        sums = np.column_stack([np.bincount(inverse[keep], scales[keep, i],
+                                            minlength=len(keys))
+                                for i in (0, 1)])
+        valid = np.flatnonzero(counts >= 4)
+        valid = valid[np.lexsort((-counts[valid], keys[valid, 1],
+                                  keys[valid, 0]))]
+        means = sums[valid] / counts[valid, None]
+        return [(int(k[0]), int(k[1]), int(k[2]), int(n), m[0], m[1])
+                for k, n, m in izip(keys[valid], counts[valid], means)]
+
+    def _outlier_removal(self, inverse, scales, n):
         """
-        data = (offset, offset + e, recordid)
+        Calculates mean/std. dev. for sTime/sFreq values of each of the
+        n groups in inverse, then removes any outliers (defined as
+        mean +/- 2 * stdv).
+        Returns: boolean mask of the values that are kept
+        """
+        counts = np.bincount(inverse, minlength=n)[:, None]
+        sums = np.column_stack([np.bincount(inverse, scales[:, i], n)
+                                for i in (0, 1)])
+        means = (sums / counts)[inverse]
+        dev = scales - means
+        var = np.column_stack([np.bincount(inverse, dev[:, i] ** 2, n)
+                               for i in (0, 1)]) / counts
+        stds = np.sqrt(var)[inverse]
+        return np.all(np.abs(dev) <= 2 * stds, axis=1)
+
+    def _validate_matches(self, fps, vThreshold, margin=None, batch=16,
+                          stats=qstats.NULL_STATS):
+        """
+        Verifies peaks of the match candidates of every fingerprint,
+        ranked by number of matches. Candidates are scored all at once,
+        or in groups of batch when stopping early after a score of
+        vThreshold + margin. The peaks of the current group of every
+        fingerprint are looked up together.
+        Returns: list of the Matches scoring at least vThreshold of
+        each fingerprint
+        """
+        ranked = [sorted(fp.match_candidates, key=lambda mc: mc.num_matches,
+                         reverse=True) for fp in fps]
+        if margin is None:
+            batch = max([len(r) for r in ranked] + [1])
+        matches = [[] for _ in fps]
+        active = [j for j, r in enumerate(ranked) if r]
+        i = 0
+        while active:
+            groups = [ranked[j][i:i + batch] for j in active]
+            bounds = np.cumsum([0] + [len(g) for g in groups])
+            with stats.time('lookup_peaks'):
+                rows = self._candidate_peaks(
+                    [mc for group in groups for mc in group])
+            stats.count('validated', bounds[-1])
+            stats.count('reference_peaks', len(rows))
+            rows = rows[np.argsort(rows[:, 0], kind='mergesort')]
+            splits = np.searchsorted(rows[:, 0], bounds)
+            remaining = []
+            for k, (j, group) in enumerate(izip(active, groups)):
+                part = rows[splits[k]:splits[k + 1]] - [bounds[k], 0, 0]
+                vScores = self._verify_peaks(group, part, fps[j].peaks)
+                for mc, vScore in izip(group, vScores.tolist()):
+                    if vScore < vThreshold:
+                        continue
+                    record = self._record_title(mc.recordid)
+                    # skips records deleted since the index was built
+                    if record is not None:
+                        matches[j].append(
+                            self.Match(record, mc.offset, vScore))
+                if margin is not None and \
+                        vScores.max() >= vThreshold + margin:
+                    continue
+                if i + batch < len(ranked[j]):
+                    remaining.append(j)
+            active = remaining
+            i += batch
+        return matches
+
+    def _candidate_peaks(self, candidates):
+        """
+        Returns: (N,3) array of (candidate index, X, Y) of the reference
+        peaks around every candidate's offset
+        """
+        conn = self.connection()
+        c = conn.cursor()
+        if self.peak_cache.max_size:
+            rows = self._lookup_cached_peaks(c, candidates)
+        else:
+            rows = self._lookup_peak_ranges(c, candidates)
+        c.close()
+        conn.commit()  # ends the transaction opened for the temp table
+        return rows
+
+    def _lookup_peak_ranges(self, c, candidates, e=3750):
+        """
+        Queries Peaks table for peaks of each candidate's record that
+        are within 3750 samples (15s) of its estimated offset value,
+        for all candidates in a single query.
+        Returns: (N,3) array of (candidate index, X, Y)
+        """
+        if self.compact_format:
+            return self._lookup_compact_peaks(c, candidates, e)
+        c.execute("""CREATE TEMP TABLE
+                     IF NOT EXISTS PeakRanges(
+                         id INTEGER PRIMARY KEY,
+                         recordid INTEGER, lo INTEGER, hi INTEGER)""")
+        c.execute("DELETE FROM PeakRanges")
+        c.executemany("""INSERT INTO PeakRanges
+                         VALUES (?,?,?,?)""",
+                      [(i, mc.recordid, mc.offset, mc.offset + e)
+                       for i, mc in enumerate(candidates)])
+        c.execute("""SELECT r.id, X, Y
+                       FROM PeakRanges AS r
+                       JOIN Peaks ON Peaks.recordid = r.recordid
+                        AND X >= r.lo AND X <= r.hi""")
+        return np.array(c.fetchall(), dtype=np.int64).reshape(-1, 3)
+
+    def _lookup_compact_peaks(self, c, candidates, e=3750):
+        """
+        Decodes the peaks of each candidate's record once, then keeps
+        those within e samples of the candidate's estimated offset
+        Returns: (N,3) array of (candidate index, X, Y)
+        """
+        peaks = dict((recordid, self._lookup_record_peaks(c, recordid))
+                     for recordid in set(mc.recordid for mc in candidates))
+        return self._peaks_in_ranges(candidates, peaks, e)
+
+    def _lookup_cached_peaks(self, c, candidates, e=3750):
+        """
+        Looks up all peaks of each candidate's record in the peak cache,
+        or the db on a miss, then keeps those within e samples of the
+        candidate's estimated offset
+        Returns: (N,3) array of (candidate index, X, Y)
+        """
+        recordids = sorted(set(mc.recordid for mc in candidates))
+        generation = self.peak_cache.generation
+        found = self.peak_cache.get_many(recordids)
+        missing = [(recordid, (self._lookup_record_peaks(c, recordid),))
+                   for recordid, value in zip(recordids, found)
+                   if value is None]
+        self.peak_cache.put_many(missing, generation)
+        peaks = dict((recordid, value[0]) for recordid, value in
+                     itertools.chain(zip(recordids, found), missing)
+                     if value is not None)
+        return self._peaks_in_ranges(candidates, peaks, e)
+
+    def _lookup_record_peaks(self, c, recordid):
+        """
+        Returns: PeakArray of all peaks of a record, sorted by X (empty
+        if the record was deleted)
+        """
+        if self.compact_format:
+            c.execute("""SELECT peaks
+                           FROM CompactPeaks
+                          WHERE recordid = ?""", (recordid,))
+            blob = c.fetchone()
+            if blob is None:
+                return as_peaks(np.empty((0, 2), dtype=np.int32))
+            return decode_peaks(blob[0])
         c.execute("""SELECT X, Y
                        FROM Peaks
-                      WHERE X >= ? AND X <= ?
-                        AND recordid = ?""", data)
-        return [self.Peak(p[0], p[1]) for p in c.fetchall()]
-
-    def _verify_peaks(self, mc, rPeaks, qPeaks, eX=18, eY=12):
-        """
-        Checks for presence of a given set of reference peaks in the
-        query fingerprint's list of peaks according to time and
-        frequency boundaries (eX and eY). Each reference peak is adjusted
-        according to estimated sFreq/sTime from candidate filtering
-        stage.
-        Returns: validation score (num. valid peaks / total peaks)
-        """
-        validated = 0
-        for rPeak in rPeaks:
-            rPeak = (rPeak.x - mc.offset, rPeak.y)
-            rPeakScaled = self.Peak(rPeak[0] / mc.sFreq, rPeak[1] / mc.sTime)
-            lBound = bisect_left(qPeaks, (rPeakScaled.x - eX, None))
-            rBound = bisect_right(qPeaks, (rPeakScaled.x + eX, None))
-            for i in xrange(lBound, rBound):
-                if not rPeakScaled.y - eY <= qPeaks[i].y <= rPeakScaled.y + eY:
-                    continue
-                else:
-                    validated += 1
-        vScore = (float(validated) / len(rPeaks))
-        return vScore
+                      WHERE recordid = ?
+                      ORDER BY X, Y""", (recordid,))
+        return as_peaks(np.array(c.fetchall(), dtype=np.int32))
+
+    def _peaks_in_ranges(self, candidates, peaks, e):
+        """
+        Returns: (N,3) array of (candidate index, X, Y) of the peaks of
+        each candidate's record (peaks maps recordid to PeakArray sorted
+        by X) within e samples of its estimated offset
+        """
+        rows = [np.empty((0, 3), dtype=np.int64)]
+        for i, mc in enumerate(candidates):
+            recordPeaks = peaks[mc.recordid]
+            lo = np.searchsorted(recordPeaks.x, mc.offset, side='left')
+            hi = np.searchsorted(recordPeaks.x, mc.offset + e, side='right')
+            found = np.empty((hi - lo, 3), dtype=np.int64)
+            found[:, 0] = i
+            found[:, 1:] = recordPeaks[lo:hi]
+            rows.append(found)
+        return np.concatenate(rows)
+
+    def _verify_peaks(self, candidates, rows, qPeaks, eX=18, eY=12):
+        """
+        Checks for presence of each candidate's reference peaks (rows
+        of candidate index, X, Y) in the query fingerprint's array of
+        peaks according to time and frequency boundaries (eX and eY).
+        Each reference peak is adjusted according to estimated
+        sFreq/sTime from candidate filtering stage. Query peaks within
+        eX of a reference peak are found with searchsorted, then
+        checked against eY all at once.
+        Returns: array of validation scores (num. valid peaks / total
+        peaks) for every candidate
+        """
+        qPeaks = as_peaks(qPeaks)
+        mc = np.array([(m.offset, m.sTime, m.sFreq) for m in candidates],
+                      dtype=np.float64).reshape(-1, 3)
+        owner = rows[:, 0]
+        rX = (rows[:, 1] - mc[owner, 0]) / mc[owner, 2]
+        rY = rows[:, 2] / mc[owner, 1]
+        lBounds = np.searchsorted(qPeaks.x, rX - eX)
+        rBounds = np.searchsorted(qPeaks.x, rX + eX)
+        pair, qIdx = expand_ranges(lBounds, rBounds)
+        qY = qPeaks.y[qIdx]
+        valid = (rY[pair] - eY <= qY) & (qY <= rY[pair] + eY)
+        validated = np.bincount(owner[pair[valid]], minlength=len(mc))
+        total = np.bincount(owner, minlength=len(mc))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vScores = validated / total.astype(np.float64)
+        return np.nan_to_num(vScores)
+
+    def _record_title(self, recordid):
+        """
+        Returns title of given recordid, or None if it was deleted
+        """
+        c = self.connection().cursor()
+        title = self._lookup_record(c, recordid)
+        c.close()
+        return title
 
     def _lookup_record(self, c, recordid):
         """
-        Returns title of given recordid
+        Returns title of given recordid, or None if it was deleted (a
+        GridIndex built before the delete still returns its hashes)
         """
         c.execute("""SELECT title
                        FROM Records
                       WHERE id = ?""", (recordid,))
         title = c.fetchone()
-        return title[0]
+        return title[0] if title else None
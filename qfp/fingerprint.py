@@ -1,5 +1,6 @@
 from __future__ import division
 
+from . import stats as qstats
 from .audio import load_audio
 from .utils import stft, find_peaks, generate_hash, n_strongest
 from .quads import find_quads
@@ -37,6 +38,16 @@ class fpType:
 
 
 class Fingerprint:
+    """
+    Audio fingerprint made of NumPy arrays:
+
+    peaks     = (N,2) int32 PeakArray of spectrogram peaks (x, y)
+    strongest = (M,8) int32 QuadArray of the strongest quads
+    hashes    = (M,4) float32 array of their hashes
+    ranks     = (M,) strength rank of each quad within its partition,
+                or None when the fingerprint was restored from a cache
+    """
+    ranks = None
 
     def __init__(self, path, fp_type):
         self.path = path
@@ -46,17 +57,47 @@ class Fingerprint:
         else:
             self.params = fp_type
 
-    def create(self, snip=None):
+    def create(self, snip=None, cache=None):
         """
-        Creates quad hashes for a given audio file
+        Creates quad hashes for a given audio file. If a qfp.storage
+        cache is given, the fingerprint is loaded from it when the same
+        audio was fingerprinted before, and stored in it otherwise.
+        With qfp.stats enabled, per-stage timings and counts are kept
+        in self.stats.
         """
+        stats = qstats.new('fingerprint')
+        key = None
+        if cache is not None:
+            with stats.time('cache'):
+                key = cache.key(self.path, self.params, snip)
+                hit = key is not None and cache.restore(self, key)
+            stats.count('cache_hits', hit)
+            if hit:
+                self.stats = qstats.finish(stats)
+                return
         q, r, c, w, h = self.params
-        samples = load_audio(self.path, snip=snip)
-        spectrogram = stft(samples)
-        self.peaks = list(find_peaks(spectrogram, w, h))
-        quads = find_quads(self.peaks, r, c)
-        self.strongest = n_strongest(spectrogram, quads, q)
-        self.hashes = [generate_hash(q) for q in self.strongest]
+        with stats.time('decode'):
+            samples = load_audio(self.path, snip=snip)
+        with stats.time('stft'):
+            spectrogram = stft(samples)
+        with stats.time('find_peaks'):
+            self.peaks = find_peaks(spectrogram, w, h)
+        with stats.time('find_quads'):
+            quads = find_quads(self.peaks, r, c)
+        with stats.time('n_strongest'):
+            self.strongest, self.ranks = n_strongest(spectrogram, quads, q,
+                                                     return_ranks=True)
+        with stats.time('generate_hash'):
+            self.hashes = generate_hash(self.strongest)
+        if key is not None:
+            with stats.time('cache'):
+                cache.store(self, key)
+        stats.count('samples', len(samples))
+        stats.count('frames', len(spectrogram))
+        stats.count('peaks', len(self.peaks))
+        stats.count('quads', len(quads))
+        stats.count('strongest', len(self.strongest))
+        self.stats = qstats.finish(stats)
 
 
 class ReferenceFingerprint(Fingerprint):
@@ -72,5 +113,5 @@ class QueryFingerprint(Fingerprint):
         self.fp_type = fpType.Query
         Fingerprint.__init__(self, path, fp_type=self.fp_type)
 
-    def create(self):
-        Fingerprint.create(self, snip=15)
+    def create(self, cache=None):
+        Fingerprint.create(self, snip=15, cache=cache)
@@ -0,0 +1,318 @@
+from __future__ import division
+import numpy as np
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+from .compact import key_ranges, range_width, decode_quads
+from .utils import expand_ranges, generate_hash
+
+try:
+    from itertools import izip
+except:
+    izip = zip
+
+
+class RTreeIndex:
+    """
+    Epsilon neighbor search over the Hashes R-tree of a QfpDB
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def query(self, hashes, e=0.01):
+        """
+        Epsilon (e) neighbor search for all query hashes at once. The
+        query hashes are loaded into a temporary table and joined
+        against the Hashes R-tree and the Quads table.
+        Returns: (index of query hash, hashid, recordid, (N,8) quads)
+        """
+        conn = self.db.connection()
+        c = conn.cursor()
+        c.execute("""CREATE TEMP TABLE
+                     IF NOT EXISTS QueryHashes(
+                         id INTEGER PRIMARY KEY,
+                         W REAL, X REAL, Y REAL, Z REAL)""")
+        c.execute("DELETE FROM QueryHashes")
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        c.executemany("""INSERT INTO QueryHashes
+                         VALUES (?,?,?,?,?)""",
+                      izip(range(len(hashes)), *hashes.T.tolist()))
+        c.execute("""SELECT q.id, h.id, Quads.recordid,
+                            Ax, Ay, Cx, Cy, Dx, Dy, Bx, By
+                       FROM QueryHashes AS q
+                       JOIN Hashes AS h
+                         ON h.minW >= q.W - :e AND h.maxW <= q.W + :e
+                        AND h.minX >= q.X - :e AND h.maxX <= q.X + :e
+                        AND h.minY >= q.Y - :e AND h.maxY <= q.Y + :e
+                        AND h.minZ >= q.Z - :e AND h.maxZ <= q.Z + :e
+                       JOIN Quads ON Quads.hashid = h.id""", {'e': e})
+        rows = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 11)
+        c.close()
+        conn.commit()  # ends the transaction opened for the temp table
+        return rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3:]
+
+
+class CompactIndex:
+    """
+    Epsilon neighbor search over the quads of a compact QfpDB, which are
+    keyed by their packed, quantized hash (see qfp.compact). The quads
+    of the key ranges covering a search box are read, and their hashes
+    are recomputed and tested exactly, as the R-tree tests its boxes.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def query(self, hashes, e=0.01):
+        """
+        Epsilon (e) neighbor search for all query hashes at once. The
+        key ranges are passed as a JSON array and joined against the
+        CompactQuads table.
+        Returns: (index of query hash, quadid, recordid, (N,8) quads),
+        quadid numbering the quads of each record
+        """
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        owner, first = key_ranges(hashes, e)
+        c = self.db.connection().cursor()
+        c.execute("""SELECT r.key, recordid, quadid, quad
+                       FROM json_each(?) AS r
+                       JOIN CompactQuads
+                         ON hashkey BETWEEN r.value AND r.value + ?""",
+                  (json.dumps(first.tolist()), range_width(e)))
+        rows = c.fetchall()
+        c.close()
+        ids = np.array([row[:3] for row in rows],
+                       dtype=np.int64).reshape(-1, 3)
+        quads = decode_quads([row[3] for row in rows])
+        qidx = owner[ids[:, 0]]
+        h = generate_hash(quads).astype(np.float64)
+        q = hashes[qidx]
+        match = np.all((h >= q - e) & (h <= q + e), axis=1)
+        # a quad is read once for every range of its hash that it is in
+        found = np.unique(np.column_stack((qidx, ids[:, 1:]))[match],
+                          axis=0, return_index=True)[1]
+        row = np.nonzero(match)[0][found]
+        return (qidx[row], ids[row, 2], ids[row, 1],
+                np.asarray(quads[row], dtype=np.int64))
+
+
+class GridIndex:
+    """
+    Quantized grid over the hashes of a QfpDB, persisted as flat .npy
+    files that are memory-mapped when the index is opened.
+
+    Hashes are sorted by the key of the grid cell they fall into, so an
+    epsilon search only has to look up the few cells overlapping the
+    search box with searchsorted. The R-tree stores each hash as a
+    float32 box, and those exact bounds are kept here so that results
+    match the RTreeIndex backend.
+
+    Build once from an existing database (of either format) and pass it
+    to QfpDB:
+
+        GridIndex.build(QfpDB('qfp.db'), 'qfp.idx')
+        db = QfpDB('qfp.db', index=GridIndex('qfp.idx'))
+
+    The index is a snapshot and must be rebuilt after storing or
+    deleting records: records stored later are not found, and the
+    hashes of deleted records only yield candidates that are skipped
+    (or fail validation, if a new record reused the id).
+    """
+    VERSION = 1
+    FILES = ('keys', 'bounds', 'hashids', 'recordids', 'quads')
+    LAYOUT = {'keys': (np.int64, ()), 'bounds': (np.float32, (8,)),
+              'hashids': (np.int64, ()), 'recordids': (np.int32, ()),
+              'quads': (np.int32, (8,))}
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != self.VERSION:
+            raise ValueError("Unsupported grid index version %s"
+                             % meta['version'])
+        self.cell = meta['cell']
+        self.size = meta['size']
+        for name in self.FILES:
+            arr = np.load(os.path.join(path, name + '.npy'),
+                          mmap_mode=mmap_mode)
+            setattr(self, name, arr)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, db, path, cell=0.02, chunksize=1000000, buckets=1 << 16):
+        """
+        Writes a grid index of every hash stored in db to directory
+        path. cell should be at least twice the search epsilon so that
+        a search box overlaps at most 2 cells per dimension. The hashes
+        of a compact db are recomputed from its quads, and their quadids
+        are stored in place of hashids, as CompactIndex returns them.
+
+        The hashes are streamed into memory-mapped files, then sorted on
+        disk: grouped into buckets of keys, and each run of buckets
+        sorted in memory. Building takes memory for about chunksize
+        hashes (or the largest bucket, if it holds more) and temporary
+        disk space for a second copy of the index.
+        """
+        c = db.connection().cursor()
+        if db.compact_format:
+            n = c.execute("SELECT COUNT(*) FROM CompactQuads").fetchone()[0]
+            c.execute("""SELECT quadid, recordid, quad
+                           FROM CompactQuads""")
+        else:
+            n = c.execute("SELECT COUNT(*) FROM Quads").fetchone()[0]
+            c.execute("""SELECT id, recordid,
+                                minW, maxW, minX, maxX, minY, maxY,
+                                minZ, maxZ, Ax, Ay, Cx, Cy, Dx, Dy, Bx, By
+                           FROM Hashes JOIN Quads ON Quads.hashid = Hashes.id
+                          ORDER BY id""")
+        size = int(np.ceil(1 / cell)) + 1
+        width = -(-size ** 4 // buckets)  # keys per bucket
+        counts = np.zeros(buckets, dtype=np.int64)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        tmp = tempfile.mkdtemp(dir=path)
+        try:
+            unsorted = cls._open_files(tmp, n)
+            for i in range(0, n, chunksize):
+                chunk = _hash_rows(c.fetchmany(chunksize), db.compact_format)
+                chunk['keys'] = _cell_keys(
+                    _cells(chunk['bounds'][:, ::2], cell, size), size)
+                for name in cls.FILES:
+                    unsorted[name][i:i + chunksize] = chunk[name]
+                counts += np.bincount(chunk['keys'] // width,
+                                      minlength=buckets)
+            c.close()
+            arrays = cls._open_files(path, n)
+            _scatter_buckets(unsorted, arrays, counts, width, chunksize)
+            _sort_buckets(arrays, counts, chunksize)
+            for name in cls.FILES:
+                arrays[name].flush()
+            del unsorted, arrays
+        finally:
+            shutil.rmtree(tmp)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': cls.VERSION, 'cell': cell, 'size': size,
+                       'count': int(n)}, f)
+        return cls(path)
+
+    @classmethod
+    def _open_files(cls, path, n):
+        """
+        Returns dict of new memory-mapped .npy files in path of n rows
+        of every array of the index
+        """
+        return dict(
+            (name, np.lib.format.open_memmap(
+                os.path.join(path, name + '.npy'), mode='w+', dtype=dtype,
+                shape=(n,) + shape))
+            for name, (dtype, shape) in cls.LAYOUT.items())
+
+    def query(self, hashes, e=0.01):
+        """
+        Epsilon (e) neighbor search for all query hashes at once.
+        Returns: (index of query hash, hashid, recordid, (N,8) quads)
+        """
+        hashes = np.asarray(hashes, dtype=np.float64).reshape(-1, 4)
+        lo = _cells(hashes - e, self.cell, self.size)
+        hi = _cells(hashes + e, self.cell, self.size)
+        # every combination of per-dimension cell steps within a box
+        span = int((hi - lo).max()) + 1 if len(hashes) else 1
+        steps = np.array(list(itertools.product(range(span), repeat=4)))
+        cells = lo[:, None, :] + steps[None, :, :]
+        inside = np.all(cells <= hi[:, None, :], axis=2)
+        qidx = np.nonzero(inside)[0]
+        keys = _cell_keys(cells[inside], self.size)
+        starts = np.searchsorted(self.keys, keys, side='left')
+        stops = np.searchsorted(self.keys, keys, side='right')
+        owner, idx = expand_ranges(starts, stops)
+        qidx = qidx[owner]
+        # exact test against the stored float32 bounds, as the R-tree does
+        b = np.asarray(self.bounds[idx], dtype=np.float64)
+        q = hashes[qidx]
+        match = np.all((b[:, ::2] >= q - e) & (b[:, 1::2] <= q + e), axis=1)
+        qidx, idx = qidx[match], idx[match]
+        return (qidx, np.asarray(self.hashids[idx]),
+                np.asarray(self.recordids[idx], dtype=np.int64),
+                np.asarray(self.quads[idx], dtype=np.int64))
+
+
+def _hash_rows(rows, compact):
+    """
+    Returns dict of the hashids, recordids, float32 bounds and quads of
+    rows read from the Hashes and Quads tables, or from CompactQuads
+    (bounds recomputed from the quads)
+    """
+    if compact:
+        hashids, recordids = np.array([row[:2] for row in rows],
+                                      dtype=np.int64).T
+        quads = decode_quads([row[2] for row in rows])
+        h = generate_hash(quads)
+        bounds = np.empty((len(rows), 8), dtype=np.float32)
+        bounds[:, ::2], bounds[:, 1::2] = h, h
+    else:
+        rows = np.array(rows, dtype=np.float64)
+        hashids, recordids = rows[:, 0], rows[:, 1]
+        bounds = rows[:, 2:10].astype(np.float32)
+        quads = rows[:, 10:]
+    return {'hashids': hashids, 'recordids': recordids, 'bounds': bounds,
+            'quads': quads}
+
+
+def _scatter_buckets(src, dst, counts, width, chunksize):
+    """
+    Copies the rows of the arrays of src to dst, grouped by bucket of
+    key (key // width, holding counts rows each) and in their original
+    order within a bucket, chunksize rows at a time
+    """
+    offsets = np.cumsum(counts) - counts
+    for i in range(0, len(src['keys']), chunksize):
+        bucket = np.asarray(src['keys'][i:i + chunksize]) // width
+        order = np.argsort(bucket, kind='mergesort')
+        bucket = bucket[order]
+        dest = (offsets[bucket] + np.arange(len(bucket)) -
+                np.searchsorted(bucket, bucket))
+        offsets += np.bincount(bucket, minlength=len(offsets))
+        for name in src:
+            dst[name][dest] = src[name][i:i + chunksize][order]
+
+
+def _sort_buckets(arrays, counts, chunksize):
+    """
+    Sorts arrays grouped by bucket by key in place (stable, as is the
+    grouping), one run of whole buckets of up to chunksize rows, or a
+    single larger bucket, at a time
+    """
+    ends = np.cumsum(counts)
+    lo = 0
+    while lo < ends[-1]:
+        last = max(np.searchsorted(ends, lo + chunksize, side='right') - 1,
+                   np.searchsorted(ends, lo, side='right'))
+        hi = ends[last]
+        order = np.argsort(arrays['keys'][lo:hi], kind='mergesort')
+        for arr in arrays.values():
+            arr[lo:hi] = arr[lo:hi][order]
+        lo = hi
+
+
+def _cells(points, cell, size):
+    """
+    Returns grid cell coordinates of (N,4) points, clipped to the grid
+    """
+    cells = np.floor(np.asarray(points, dtype=np.float64) / cell)
+    return np.clip(cells, 0, size - 1).astype(np.int64)
+
+
+def _cell_keys(cells, size):
+    """
+    Ravels (N,4) cell coordinates into int64 keys
+    """
+    return ((cells[:, 0] * size + cells[:, 1]) * size
+            + cells[:, 2]) * size + cells[:, 3]
+
@@ -0,0 +1,84 @@
+from __future__ import division, print_function
+from multiprocessing import Pool
+import numpy as np
+import os
+
+from .fingerprint import fpType, ReferenceFingerprint, QueryFingerprint
+from .utils import as_peaks, as_quads
+
+FINGERPRINTS = {fpType.Reference: ReferenceFingerprint,
+                fpType.Query: QueryFingerprint}
+
+
+def fingerprint_many(paths, fp_type=fpType.Reference, workers=None,
+                     cache=None):
+    """
+    Fingerprints audio files in a pool of worker processes. Workers
+    send back peaks, quads and hashes as compact arrays. If a
+    qfp.storage.Storage cache is given, workers load fingerprints of
+    previously seen audio from it.
+    Yields: (path, fingerprint) in order of completion. Files that
+    could not be fingerprinted are reported and skipped.
+    """
+    if fp_type not in FINGERPRINTS:
+        raise TypeError(
+            "Fingerprint must be of type 'Reference' or 'Query'")
+    pool = Pool(workers)
+    try:
+        jobs = ((path, fp_type, cache) for path in paths)
+        for path, arrays in pool.imap_unordered(_fingerprint_file, jobs):
+            if isinstance(arrays, str):
+                print("failed to fingerprint %s: %s" % (path, arrays))
+                continue
+            fp = FINGERPRINTS[fp_type](path)
+            peaks, quads, fp.hashes = arrays
+            fp.peaks, fp.strongest = as_peaks(peaks), as_quads(quads)
+            yield path, fp
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def ingest(db, paths, workers=None, batch_size=100, title=None,
+           cache=None):
+    """
+    Fingerprints reference audio files in parallel and stores them in
+    db from this process only, so SQLite is never written concurrently.
+    Files whose title is already stored are skipped, so an interrupted
+    ingest can be resumed by running it again. title maps a path to a
+    record title and defaults to the file name without its extension.
+    cache is passed on to fingerprint_many.
+    Returns: number of records stored per second
+    """
+    title = title or default_title
+    stored = db.titles()
+    pending = [p for p in paths if title(p) not in stored]
+    print("%d files to fingerprint, %d already stored" %
+          (len(pending), len(paths) - len(pending)))
+    fps = ((fp, title(path)) for path, fp in
+           fingerprint_many(pending, fpType.Reference, workers, cache))
+    return db.store_many(fps, batch_size=batch_size)
+
+
+def default_title(path):
+    """
+    Returns file name of path without its extension
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _fingerprint_file(job):
+    """
+    Worker process entry point. Returns (path, (peaks, quads, hashes))
+    or (path, error message).
+    """
+    path, fp_type, cache = job
+    try:
+        fp = FINGERPRINTS[fp_type](path)
+        fp.create(cache=cache)
+    except Exception as e:
+        return path, "%s: %s" % (type(e).__name__, e)
+    # ship plain ndarrays, the array views are restored by the parent
+    arrays = (fp.peaks, fp.strongest, fp.hashes)
+    return path, tuple(np.asarray(a) for a in arrays)
@@ -1,80 +1,110 @@
 # This Python file uses the following encoding: utf-8
 from __future__ import division
 
-from bisect import bisect_left, bisect_right
-from collections import namedtuple
-from itertools import combinations
+import numpy as np
 
+from .utils import as_peaks, as_quads
 
-def find_quads(peaks, r, c):
+# upper bound on the size of the boolean (C, D, B) masks built per chunk
+MAX_MASK_SIZE = 1 << 20
+
+
+def find_quads(peaks, r, c, limit=None, spec=None):
     """
-    Returns list of valid/strong quads for list of peaks
+    Returns QuadArray of valid quads for PeakArray of peaks, in the
+    order of their root (A), then of C, D and B within the window.
+    limit optionally caps the number of quads kept per root. If spec
+    is given the strongest quads (by magnitudes of C and D) are kept,
+    otherwise the first ones found.
     """
-    quads = []
-    for root in peaks:
-        quads += _root_quads(root, peaks, r, c)
-    return quads
+    peaks = as_peaks(peaks)
+    magnitudes = None
+    if limit is not None and spec is not None:
+        magnitudes = spec[peaks.x, peaks.y]
+    return root_quads(peaks, np.arange(len(peaks)), r, c, limit, magnitudes)
 
 
-def _root_quads(root, peaks, r, c):
+def root_quads(peaks, roots, r, c, limit=None, magnitudes=None):
     """
-    finds valid quads for given root
+    Returns QuadArray of valid quads of the given root indices into
+    PeakArray peaks. See find_quads; magnitudes holds the spectrogram
+    magnitude of every peak and is only used with limit.
     """
-    quads = []
-    filtered = _filter_peaks(root, peaks, r, c)
-    if filtered is None:
-        return []
-    found = _valid_quads(root, filtered)
-    if found is not None:
-        quads += found
-    return quads
+    a, cdb = quad_indices(peaks, roots, r, c, limit, magnitudes)
+    quads = np.empty((len(a), 8), dtype=np.int32)
+    quads[:, 0:2] = peaks[a]
+    quads[:, 2:8] = peaks[cdb].reshape(-1, 6)
+    return as_quads(quads)
 
 
-def _filter_peaks(root, peaks, r, c):
+def quad_indices(peaks, roots, r, c, limit=None, magnitudes=None):
     """
-    returns peaks inside window of Ax + c ± (r / 2)
+    Same as root_quads, but returns indices into peaks.
+    Returns: (M,) indices of A and (M,3) indices of C, D and B
     """
-    lastPeak = peaks[-1].x
-    windowStart = root.x + c - (r / 2)
-    if windowStart > lastPeak:
-        return None
-    windowEnd = windowStart + r
-    idx_start = bisect_left(peaks, (windowStart, None))
-    idx_end = bisect_right(peaks, (windowEnd, None))
-    filtered = peaks[idx_start:idx_end]
-    if len(filtered) < 3:
-        return None
-    return filtered
+    starts, ends = _windows(peaks, r, c)
+    a, cdb = [], []
+    for i in roots[ends[roots] - starts[roots] >= 3]:
+        idx = _root_quads(peaks.y, i, starts[i], ends[i])
+        if idx is None:
+            continue
+        if limit is not None and len(idx) > limit:
+            if magnitudes is None:
+                idx = idx[:limit]
+            else:
+                strength = magnitudes[idx[:, 0]] + magnitudes[idx[:, 1]]
+                keep = np.argsort(-strength, kind='mergesort')[:limit]
+                idx = idx[np.sort(keep)]
+        a.append(np.full(len(idx), i, dtype=np.intp))
+        cdb.append(idx)
+    if len(a) == 0:
+        return np.empty(0, dtype=np.intp), np.empty((0, 3), dtype=np.intp)
+    return np.concatenate(a), np.concatenate(cdb)
 
 
-def _valid_quads(root, filtered):
+def _windows(peaks, r, c):
     """
-    returns list of validated quads for given root (A)
+    returns [start, end) indices of the peaks inside the window of
+    Ax + c ± (r / 2) for every root
     """
-    Quad = namedtuple('Quad', ['A', 'C', 'D', 'B'])
-    validQuads = []
-    for comb in combinations(filtered, 3):
-        quad = Quad(root, comb[0], comb[1], comb[2])
-        if _valid_quad(quad):
-            validQuads.append(quad)
-    if len(validQuads) is 0:
-        return None
-    else:
-        return validQuads
+    windowStart = peaks.x + c - (r / 2)
+    windowEnd = windowStart + r
+    return (np.searchsorted(peaks.x, windowStart),
+            np.searchsorted(peaks.x, windowEnd))
 
 
-def _valid_quad(q):
+def _root_quads(y, i, start, end):
     """
-    Evaluates:
+    finds valid quads for root i among the peaks in [start, end),
+    which are sorted by x. A quad is valid if:
 
           Ay < By
       Ax < Cx <= Dx <= Bx
       Ay < Cy ,  Dy <= By
 
-    !! NOTE: assumes combinations are sorted by x value
-    (default behavior of itertools.combinations)
+    Returns: (M,3) array of peak indices of C, D and B, or None
     """
-    if q.A.y < q.C.y < q.B.y and q.A.y < q.D.y <= q.B.y:
-        return True
-    else:
-        return False
+    # C, D and B all lie above the root
+    window = start + np.flatnonzero(y[start:end] > y[i])
+    m = len(window)
+    if m < 3:
+        return None
+    wy = y[window]
+    # cAllowed[j, l]: C = j and B = l,  dAllowed[k, l]: D = k and B = l
+    cAllowed = np.triu(wy[:, None] < wy[None, :], 1)
+    dAllowed = np.triu(wy[:, None] <= wy[None, :], 1)
+    order = np.arange(m)
+    step = max(1, MAX_MASK_SIZE // (m * m))
+    found = []
+    for j in range(0, m - 2, step):
+        js = order[j:j + step]
+        # valid[j, k, l] for j < k < l
+        valid = (cAllowed[js, None, :] & dAllowed[None, :, :] &
+                 (js[:, None, None] < order[None, :, None]))
+        jj, kk, ll = np.nonzero(valid)
+        found.append(np.column_stack((js[jj], kk, ll)))
+    idx = np.concatenate(found)
+    if len(idx) == 0:
+        return None
+    return window[idx]
+
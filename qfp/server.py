@@ -0,0 +1,353 @@
+from __future__ import division, print_function
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import json
+import numpy as np
+import os
+import signal
+import socket
+import time
+
+from .audio import DecodeError
+from .fingerprint import QueryFingerprint
+from .utils import as_peaks, as_quads
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+"""
+Asyncio identification service. Clips are posted as raw audio bytes:
+
+    POST /identify[?vThreshold=0.5]   ->  {"matches": [...], "latency": s}
+    GET  /stats                       ->  latency percentiles, queue depth,
+                                          db cache hits and misses
+
+Decoding and fingerprinting run in a pool of worker processes and db
+lookups in a pool of threads. Both stages are fed by bounded queues;
+when the decode queue is full new clips are rejected with 503 instead
+of piling up, and a full query queue holds back the decode stage.
+"""
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class IdentificationServer:
+    """
+    Serves QfpDB lookups of audio clips over HTTP, on a TCP port or a
+    unix socket. Clips waiting in the query queue are identified
+    together with QfpDB.query_many, up to batch_size at a time.
+    """
+
+    def __init__(self, db, workers=None, threads=4, queue_size=64,
+                 batch_size=8, vThreshold=0.5, max_clip=1 << 26,
+                 window=1000):
+        self.db = db
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.vThreshold = vThreshold
+        self.max_clip = max_clip
+        self.latencies = deque(maxlen=window)
+        self.counts = {'requests': 0, 'identified': 0, 'rejected': 0,
+                       'errors': 0}
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8000, path=None):
+        """
+        Starts the worker pools and listens on host:port, or on the
+        unix socket path if given
+        """
+        self.processes = ProcessPoolExecutor(self.workers)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.decode_queue = asyncio.Queue(self.queue_size)
+        self.query_queue = asyncio.Queue(self.queue_size)
+        self.tasks = [asyncio.ensure_future(self._decode())
+                      for _ in range(self.workers)]
+        self.tasks += [asyncio.ensure_future(self._query())
+                       for _ in range(self.threads)]
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def close(self):
+        """
+        Stops listening, cancels pending clips and shuts the pools down
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.processes.shutdown(cancel_futures=True)
+        self.pool.shutdown()
+
+    @property
+    def address(self):
+        """
+        Returns address the server listens on
+        """
+        return self.server.sockets[0].getsockname()
+
+    async def identify(self, data, vThreshold=None):
+        """
+        Queues clip bytes for identification. Raises asyncio.QueueFull
+        when the decode queue is full, ValueError when the clip can not
+        be decoded and RuntimeError when fingerprinting fails otherwise.
+        Returns: list of Matches
+        """
+        future = asyncio.get_running_loop().create_future()
+        vThreshold = self.vThreshold if vThreshold is None else vThreshold
+        self.decode_queue.put_nowait((data, vThreshold, future))
+        return await future
+
+    def stats(self):
+        """
+        Returns dict of request counts, queue depths, latency
+        percentiles (in seconds) of the last identified clips and the
+        db's cache_stats
+        """
+        stats = dict(self.counts)
+        stats['decode_queue'] = self.decode_queue.qsize()
+        stats['query_queue'] = self.query_queue.qsize()
+        stats['queue_size'] = self.queue_size
+        latencies = np.array(self.latencies)
+        for p in (50, 90, 99):
+            stats['p%d' % p] = (float(np.percentile(latencies, p))
+                                if len(latencies) else None)
+        stats['cache'] = self.db.cache_stats()
+        return stats
+
+    async def _decode(self):
+        """
+        Decode stage: fingerprints queued clips in the process pool
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            data, vThreshold, future = await self.decode_queue.get()
+            try:
+                arrays = await loop.run_in_executor(
+                    self.processes, _fingerprint_clip, data)
+            except DecodeError as e:
+                # the client sent something that is not audio: 400
+                if not future.done():
+                    future.set_exception(ValueError(
+                        "could not fingerprint clip: %s" % e))
+                continue
+            except Exception as e:
+                # e.g. ffmpeg missing or a worker died: 500
+                if not future.done():
+                    future.set_exception(RuntimeError(
+                        "fingerprinting failed: %s: %s"
+                        % (type(e).__name__, e)))
+                continue
+            if not future.done():
+                await self.query_queue.put((arrays, vThreshold, future))
+
+    async def _query(self):
+        """
+        Query stage: identifies batches of fingerprinted clips in the
+        thread pool
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.query_queue.get()]
+            while len(jobs) < self.batch_size \
+                    and not self.query_queue.empty():
+                jobs.append(self.query_queue.get_nowait())
+            # query_many applies one vThreshold, so keep 0 and filter
+            fps = [_restore(arrays) for arrays, _, _ in jobs]
+            try:
+                results = await loop.run_in_executor(
+                    self.pool, self.db.query_many, fps, 0.0)
+            except Exception as e:
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, vThreshold, future), matches in zip(jobs, results):
+                if not future.done():
+                    future.set_result([m for m in matches
+                                       if m.vScore >= vThreshold])
+
+    async def _handle(self, reader, writer):
+        """
+        Answers a single HTTP request per connection
+        """
+        try:
+            status, body = await self._respond(reader)
+        except Exception as e:
+            status, body = 500, {'error': "%s: %s" % (type(e).__name__, e)}
+        if status >= 400:
+            self.counts['errors' if status != 503 else 'rejected'] += 1
+        payload = json.dumps(body).encode('utf-8')
+        head = ("HTTP/1.1 %d %s\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: close\r\n\r\n"
+                % (status, REASONS[status], len(payload)))
+        try:
+            writer.write(head.encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        """
+        Reads an HTTP request and routes it
+        Returns: (status code, JSON-serializable body)
+        """
+        start = time.time()
+        line = await reader.readline()
+        try:
+            method, target, _ = line.decode('latin-1').split()
+        except ValueError:
+            return 400, {'error': 'malformed request line'}
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition('?')
+        if path == '/stats':
+            if method != 'GET':
+                return 405, {'error': 'use GET'}
+            return 200, self.stats()
+        if path != '/identify':
+            return 404, {'error': 'unknown path %s' % path}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        self.counts['requests'] += 1
+        length = int(headers.get('content-length', 0))
+        if length > self.max_clip:
+            return 413, {'error': 'clip larger than %d bytes' % self.max_clip}
+        data = await reader.readexactly(length)
+        params = dict(p.partition('=')[::2] for p in query.split('&') if p)
+        try:
+            vThreshold = float(params.get('vThreshold', self.vThreshold))
+            matches = await self.identify(data, vThreshold)
+        except asyncio.QueueFull:
+            return 503, {'error': 'server busy, retry later'}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        latency = time.time() - start
+        self.latencies.append(latency)
+        self.counts['identified'] += 1
+        return 200, {'matches': [m._asdict() for m in matches],
+                     'latency': latency}
+
+
+def serve(db, host='127.0.0.1', port=8000, path=None, **kwargs):
+    """
+    Runs an IdentificationServer for db until interrupted or
+    terminated
+    """
+    server = IdentificationServer(db, **kwargs)
+
+    async def run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        await server.start(host, port, path)
+        print("serving on %s" % (server.address,))
+        try:
+            await stop.wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def identify(audio, host='127.0.0.1', port=8000, path=None, vThreshold=None,
+             timeout=60):
+    """
+    Client for a running IdentificationServer. audio is the path of an
+    audio file or its contents as bytes.
+    Returns: list of match dicts (record, offset, vScore)
+    """
+    if not isinstance(audio, bytes):
+        with open(audio, 'rb') as f:
+            audio = f.read()
+    target = '/identify'
+    if vThreshold is not None:
+        target += '?vThreshold=%s' % vThreshold
+    return _request('POST', target, audio, host, port, path,
+                    timeout)['matches']
+
+
+def server_stats(host='127.0.0.1', port=8000, path=None, timeout=60):
+    """
+    Returns stats dict of a running IdentificationServer
+    """
+    return _request('GET', '/stats', None, host, port, path, timeout)
+
+
+def _request(method, target, body, host, port, path, timeout):
+    """
+    Sends a request to the server and decodes its JSON reply. Raises
+    IOError for error responses.
+    """
+    if path is not None:
+        conn = _UnixConnection(path, timeout)
+    else:
+        conn = HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, target, body)
+        response = conn.getresponse()
+        reply = json.loads(response.read().decode('utf-8'))
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise IOError("%d %s: %s" % (response.status, response.reason,
+                                     reply.get('error')))
+    return reply
+
+
+class _UnixConnection(HTTPConnection):
+    """
+    HTTPConnection over a unix socket
+    """
+
+    def __init__(self, socket_path, timeout):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _fingerprint_clip(data):
+    """
+    Worker process entry point. Fingerprints clip bytes.
+    Returns: (peaks, strongest, hashes) arrays
+    """
+    fp = QueryFingerprint(data)
+    fp.create()
+    return tuple(np.asarray(a) for a in (fp.peaks, fp.strongest, fp.hashes))
+
+
+def _restore(arrays):
+    """
+    Returns QueryFingerprint of the arrays sent back by a worker
+    """
+    fp = QueryFingerprint(None)
+    peaks, strongest, fp.hashes = arrays
+    fp.peaks, fp.strongest = as_peaks(peaks), as_quads(strongest)
+    return fp
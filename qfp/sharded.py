@@ -0,0 +1,224 @@
+from __future__ import division, print_function
+from concurrent.futures import ThreadPoolExecutor, wait
+import glob
+import numpy as np
+import os
+import time
+import zlib
+
+from qfp.db import QfpDB
+from qfp.fingerprint import fpType
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+
+class ShardedQfpDB(QfpDB):
+    """
+    QfpDB partitioned by record across several SQLite files, each
+    with its own R-tree. Records are placed by a hash of their title.
+
+    Hash lookups are fanned out to all shards concurrently in a pool of
+    threads (SQLite releases the GIL while it searches), and the quads
+    found in every shard are merged before binning, so candidates are
+    scored exactly as in a single QfpDB. Reference peaks are then
+    fetched from the shard of each candidate. Record ids of candidates
+    are global: recordid * number of shards + shard.
+
+    store, store_many, delete, replace, compact, query, query_many,
+    titles and cache_stats work like those of QfpDB. store_many loads
+    all shards in parallel.
+    """
+
+    def __init__(self, path='qfp.shards', shards=4, readonly=False,
+                 pragmas=None, compact=None, immutable=False, cache_size=0):
+        """
+        Opens (or creates) shards database files in directory path.
+        The number of shards of an existing directory can not change.
+        compact selects the storage format of new shards, and immutable
+        opens them as in QfpDB. Every shard gets caches of cache_size
+        bytes.
+        """
+        existing = glob.glob(os.path.join(path, 'shard*.db'))
+        if existing and len(existing) != shards:
+            raise ValueError("%s has %d shards, not %d"
+                             % (path, len(existing), shards))
+        readonly = readonly or immutable
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.readonly = readonly
+        self.immutable = immutable
+        self.shards = [QfpDB(os.path.join(path, 'shard%03d.db' % i),
+                             readonly=readonly, pragmas=pragmas,
+                             compact=compact, immutable=immutable,
+                             cache_size=cache_size)
+                       for i in range(shards)]
+        self.compact_format = self.shards[0].compact_format
+        self.pool = ThreadPoolExecutor(shards)
+        self._create_named_tuples()
+
+    def close(self):
+        """
+        Closes the connections of all shards
+        """
+        for shard in self.shards:
+            shard.close()
+
+    def shard_of(self, title):
+        """
+        Returns index of the shard storing the record title
+        """
+        return zlib.crc32(title.encode('utf-8')) % len(self.shards)
+
+    """
+    STORING FINGERPRINTS
+    """
+
+    def store(self, fp, title):
+        """
+        Stores a reference fingerprint in the shard of its title
+        """
+        self.shards[self.shard_of(title)].store(fp, title)
+
+    def store_many(self, fps, batch_size=100, pragmas=None):
+        """
+        Bulk-stores an iterable of (reference fingerprint, title) pairs,
+        every shard loading its records with QfpDB.store_many in its
+        own thread
+        Returns: number of fingerprints ingested per second
+        """
+        start = time.time()
+        queues = [Queue(batch_size) for _ in self.shards]
+        futures = [self.pool.submit(shard.store_many, iter(q.get, None),
+                                    batch_size, pragmas)
+                   for shard, q in zip(self.shards, queues)]
+        count = 0
+        try:
+            for fp, title in fps:
+                if fp.fp_type != fpType.Reference:
+                    raise TypeError(
+                        "May only store reference fingerprints in db")
+                i = self.shard_of(title)
+                if not _put(queues[i], (fp, title), futures[i]):
+                    futures[i].result()  # raises the shard's error
+                count += 1
+        finally:
+            # ends every shard's store_many, even after one has failed
+            for q, future in zip(queues, futures):
+                _put(q, None, future)
+            wait(futures)
+        for future in futures:
+            future.result()
+        return count / max(time.time() - start, 1e-9)
+
+    def titles(self):
+        """
+        Returns set of all record titles stored in the shards
+        """
+        titles = set()
+        for shard in self.shards:
+            titles |= shard.titles()
+        return titles
+
+    """
+    MAINTAINING DB
+    """
+
+    def delete(self, title):
+        """
+        Deletes the record title from its shard
+        Returns: True if the record was stored, False otherwise
+        """
+        return self.shards[self.shard_of(title)].delete(title)
+
+    def replace(self, fp, title):
+        """
+        Stores a reference fingerprint in place of the record title
+        """
+        self.shards[self.shard_of(title)].replace(fp, title)
+
+    def compact(self):
+        """
+        Compacts all shards concurrently
+        """
+        list(self.pool.map(lambda shard: shard.compact(), self.shards))
+
+    """
+    QUERYING DB
+    """
+
+    def cache_stats(self):
+        """
+        Returns dict of the hits, misses, entries and bytes of the hash
+        and peak caches, summed over all shards
+        """
+        total = {}
+        for shard in self.shards:
+            for name, counts in shard.cache_stats().items():
+                summed = total.setdefault(name, dict.fromkeys(counts, 0))
+                for key, value in counts.items():
+                    summed[key] += value
+        return total
+
+    def _query_index(self, hashes):
+        """
+        Searches the index of every shard concurrently.
+        Returns: (index of hash, global recordid, (N,8) quads)
+        """
+        n = len(self.shards)
+        results = list(self.pool.map(lambda s: s._query_index(hashes),
+                                     self.shards))
+        qidx = np.concatenate([r[0] for r in results])
+        recordids = np.concatenate([r[1] * n + i
+                                    for i, r in enumerate(results)])
+        quads = np.concatenate([r[2] for r in results])
+        order = np.argsort(qidx, kind='mergesort')
+        return qidx[order], recordids[order], quads[order]
+
+    def _candidate_peaks(self, candidates):
+        """
+        Fetches the reference peaks of the candidates from their
+        shards concurrently
+        Returns: (N,3) array of (candidate index, X, Y)
+        """
+        n = len(self.shards)
+        jobs = []
+        for i, shard in enumerate(self.shards):
+            idx = [k for k, mc in enumerate(candidates)
+                   if mc.recordid % n == i]
+            if idx:
+                local = [candidates[k]._replace(
+                    recordid=candidates[k].recordid // n) for k in idx]
+                jobs.append((shard, np.array(idx), local))
+        results = self.pool.map(lambda job: job[0]._candidate_peaks(job[2]),
+                                jobs)
+        rows = [np.empty((0, 3), dtype=np.int64)]
+        for (_, idx, _), shardRows in zip(jobs, results):
+            shardRows[:, 0] = idx[shardRows[:, 0]]
+            rows.append(shardRows)
+        return np.concatenate(rows)
+
+    def _record_title(self, recordid):
+        """
+        Returns title of given global recordid
+        """
+        n = len(self.shards)
+        return self.shards[recordid % n]._record_title(recordid // n)
+
+
+def _put(queue, item, future):
+    """
+    Puts item in queue unless the thread consuming it (future) has
+    finished
+    Returns: True if item was put
+    """
+    while True:
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            if future.done():
+                return False
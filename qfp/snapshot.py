@@ -0,0 +1,215 @@
+from __future__ import division
+import json
+import numpy as np
+import os
+
+from qfp.cache import LRUCache
+from qfp.db import QfpDB
+from qfp.index import GridIndex
+from qfp.compact import decode_peaks, count_peaks
+from qfp.utils import expand_ranges
+
+"""
+Read-only snapshots of a QfpDB for serving queries from many processes.
+
+A snapshot directory holds everything a query reads as flat .npy files:
+a GridIndex of the hashes and quads, the peaks of every record sorted by
+record and X, and the record titles. Opening a snapshot memory-maps the
+files, so all processes serving one snapshot share a single copy of it
+in the OS page cache, and an extra worker adds next to no memory.
+
+    peakkeys     int64 record index << 32 | X, sorted
+    peaky        int32 Y of every peak
+    recordids    int64 sorted record ids
+    titlebytes   uint8 UTF-8 titles, concatenated in record id order
+    titlestarts  int64 offset of every title in titlebytes, and the end
+"""
+
+MAX_X = (1 << 32) - 1
+FILES = ('peakkeys', 'peaky', 'recordids', 'titlebytes', 'titlestarts')
+
+
+class SnapshotQfpDB(QfpDB):
+    """
+    Read-only QfpDB served from a snapshot directory written by build.
+    It opens no SQLite connection and queries get the same matches as
+    from the QfpDB the snapshot was built from. cache_size caches hash
+    lookups as in QfpDB.
+
+        SnapshotQfpDB.build(QfpDB('qfp.db', readonly=True), 'qfp.snap')
+        db = SnapshotQfpDB('qfp.snap')
+
+    A snapshot does not see records stored after it was built; build a
+    new one and switch the workers over to it.
+    """
+    VERSION = 1
+
+    def __init__(self, path, mmap_mode='r', cache_size=0):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != self.VERSION:
+            raise ValueError("Unsupported snapshot version %s"
+                             % meta['version'])
+        self.path = path
+        self.readonly = True
+        self.compact_format = meta['compact']
+        self.index = GridIndex(os.path.join(path, 'index'), mmap_mode)
+        self.hash_cache = LRUCache(cache_size)
+        self.peak_cache = LRUCache(0)  # peaks are looked up in place
+        for name in FILES:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'),
+                                        mmap_mode=mmap_mode))
+        self._create_named_tuples()
+
+    @classmethod
+    def build(cls, db, path, chunksize=1000000):
+        """
+        Writes a snapshot of every record stored in db to directory
+        path, reading db in one transaction. The index and the peaks
+        are written chunksize rows at a time through memory-mapped
+        files (see GridIndex.build), so only the records' ids and
+        titles are held in memory whole.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        conn = db.connection()
+        conn.execute("BEGIN")
+        try:
+            GridIndex.build(db, os.path.join(path, 'index'),
+                            chunksize=chunksize)
+            c = conn.cursor()
+            c.execute("SELECT id, title FROM Records ORDER BY id")
+            records = c.fetchall()
+            recordids = np.array([r[0] for r in records], dtype=np.int64)
+            if db.compact_format:
+                numPeaks = _write_compact_peaks(c, recordids, path)
+            else:
+                numPeaks = _write_peaks(c, recordids, path, chunksize)
+            c.close()
+        finally:
+            conn.commit()
+        titles = [r[1].encode('utf-8') for r in records]
+        arrays = {
+            'recordids': recordids,
+            'titlebytes': np.frombuffer(b''.join(titles), dtype=np.uint8),
+            'titlestarts': np.cumsum([0] + [len(t) for t in titles],
+                                     dtype=np.int64)}
+        for name in ('recordids', 'titlebytes', 'titlestarts'):
+            np.save(os.path.join(path, name + '.npy'), arrays[name])
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': cls.VERSION,
+                       'compact': bool(db.compact_format),
+                       'records': len(records), 'peaks': numPeaks}, f)
+        return cls(path)
+
+    def connection(self):
+        """
+        Raises ValueError: a snapshot has no db to store into or delete
+        from
+        """
+        raise ValueError("%s is a read-only snapshot" % self.path)
+
+    def close(self):
+        """
+        Does nothing: the files are unmapped once the snapshot is
+        garbage collected
+        """
+
+    def titles(self):
+        """
+        Returns set of all record titles in the snapshot
+        """
+        return set(self._title(i) for i in range(len(self.recordids)))
+
+    def _candidate_peaks(self, candidates, e=3750):
+        """
+        Finds the peaks of each candidate's record that are within e
+        samples of its estimated offset with searchsorted
+        Returns: (N,3) array of (candidate index, X, Y)
+        """
+        mc = np.array([(m.recordid, m.offset) for m in candidates],
+                      dtype=np.int64).reshape(-1, 2)
+        first = np.searchsorted(self.recordids, mc[:, 0]) << 32
+        lo = np.searchsorted(self.peakkeys,
+                             first + np.clip(mc[:, 1], 0, MAX_X))
+        hi = np.searchsorted(self.peakkeys,
+                             first + np.clip(mc[:, 1] + e, -1, MAX_X),
+                             side='right')
+        owner, idx = expand_ranges(lo, hi)
+        rows = np.empty((len(idx), 3), dtype=np.int64)
+        rows[:, 0] = owner
+        rows[:, 1] = self.peakkeys[idx] & MAX_X
+        rows[:, 2] = self.peaky[idx]
+        return rows
+
+    def _record_title(self, recordid):
+        """
+        Returns title of given recordid
+        """
+        return self._title(np.searchsorted(self.recordids, recordid))
+
+    def _title(self, i):
+        """
+        Returns title of the i-th record
+        """
+        start, stop = self.titlestarts[i], self.titlestarts[i + 1]
+        return self.titlebytes[start:stop].tobytes().decode('utf-8')
+
+
+def _write_peaks(c, recordids, path, chunksize):
+    """
+    Writes peakkeys and peaky of all peaks to path, chunksize peaks at
+    a time, in the order of recordid, X and Y
+    Returns: number of peaks
+    """
+    n = c.execute("SELECT COUNT(*) FROM Peaks").fetchone()[0]
+    peakkeys, peaky = _open_peak_files(path, n)
+    c.execute("SELECT recordid, X, Y FROM Peaks ORDER BY recordid, X, Y")
+    for i in range(0, n, chunksize):
+        rows = np.array(c.fetchmany(chunksize), dtype=np.int64)
+        _set_peaks(peakkeys, peaky, i, recordids, rows[:, 0], rows[:, 1:])
+    peakkeys.flush()
+    peaky.flush()
+    return n
+
+
+def _write_compact_peaks(c, recordids, path):
+    """
+    Writes peakkeys and peaky of all peaks of a compact db to path, a
+    record at a time, in the order of recordid and X
+    Returns: number of peaks
+    """
+    c.execute("""SELECT substr(peaks, 1, 2), length(peaks)
+                   FROM CompactPeaks""")
+    n = sum(count_peaks(header, length) for header, length in c)
+    peakkeys, peaky = _open_peak_files(path, n)
+    c.execute("SELECT recordid, peaks FROM CompactPeaks ORDER BY recordid")
+    i = 0
+    for recordid, blob in c:
+        recordPeaks = decode_peaks(blob)
+        _set_peaks(peakkeys, peaky, i, recordids, recordid, recordPeaks)
+        i += len(recordPeaks)
+    peakkeys.flush()
+    peaky.flush()
+    return n
+
+
+def _open_peak_files(path, n):
+    """
+    Returns: new memory-mapped peakkeys and peaky files of n peaks
+    """
+    return [np.lib.format.open_memmap(os.path.join(path, name + '.npy'),
+                                      mode='w+', dtype=dtype, shape=(n,))
+            for name, dtype in (('peakkeys', np.int64),
+                                ('peaky', np.int32))]
+
+
+def _set_peaks(peakkeys, peaky, i, recordids, recordid, peaks):
+    """
+    Sets the keys and Y of peaks (X, Y) of recordid (one, or one per
+    peak) from row i on
+    """
+    j = i + len(peaks)
+    peakkeys[i:j] = (np.searchsorted(recordids, recordid) << 32) + \
+        peaks[:, 0].astype(np.int64)
+    peaky[i:j] = peaks[:, 1]
@@ -0,0 +1,129 @@
+from __future__ import division
+from timeit import default_timer as timer
+
+"""
+Optional instrumentation of Fingerprint.create and QfpDB queries.
+Disabled by default; the instrumented code then only gets a shared
+no-op stats object. Once enabled, every fingerprint gets a Stats of the
+time spent in each stage and counters such as the number of peaks or
+index hits, and the callback (if any) is called with each finished
+Stats:
+
+    from qfp import stats
+    stats.enable(lambda s: print(s.name, s.timers, s.counters))
+    fp.create()
+    print(fp.stats)         # Stats('fingerprint', ...)
+    db.query(fp)
+    print(fp.query_stats)   # Stats('query', ...)
+"""
+
+_enabled = False
+_callback = None
+
+
+def enable(callback=None):
+    """
+    Turns instrumentation on. callback is called with every finished
+    Stats.
+    """
+    global _enabled, _callback
+    _enabled, _callback = True, callback
+
+
+def disable():
+    """
+    Turns instrumentation off
+    """
+    global _enabled, _callback
+    _enabled, _callback = False, None
+
+
+def new(name):
+    """
+    Returns a new Stats if instrumentation is enabled, else NULL_STATS
+    """
+    return Stats(name) if _enabled else NULL_STATS
+
+
+def finish(stats):
+    """
+    Passes a finished Stats to the callback.
+    Returns: stats if instrumentation is enabled, else None
+    """
+    if not stats.enabled:
+        return None
+    if _callback is not None:
+        _callback(stats)
+    return stats
+
+
+class Stats:
+    """
+    Timers (seconds per stage) and counters of one instrumented call
+    """
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.timers = {}
+        self.counters = {}
+
+    def time(self, stage):
+        """
+        Returns context manager adding its duration to timer stage
+        """
+        return _Timer(self, stage)
+
+    def count(self, counter, n=1):
+        """
+        Adds n to counter
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + int(n)
+
+    def as_dict(self):
+        return {'name': self.name, 'timers': dict(self.timers),
+                'counters': dict(self.counters)}
+
+    def __repr__(self):
+        return "Stats(%r, timers=%r, counters=%r)" % (
+            self.name, self.timers, self.counters)
+
+
+class _Timer:
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = timer()
+
+    def __exit__(self, *exc):
+        timers = self.stats.timers
+        timers[self.stage] = timers.get(self.stage, 0.0) + timer() - self.start
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _NullStats:
+    """
+    Stand-in for Stats while instrumentation is disabled
+    """
+    enabled = False
+    _timer = _NullTimer()
+
+    def time(self, stage):
+        return self._timer
+
+    def count(self, counter, n=1):
+        pass
+
+
+NULL_STATS = _NullStats()
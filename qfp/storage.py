@@ -0,0 +1,205 @@
+from __future__ import division
+import hashlib
+import numpy as np
+import os
+import struct
+import tempfile
+
+from .fingerprint import fpType, ReferenceFingerprint, QueryFingerprint
+from .utils import as_peaks, as_quads, as_hashes
+
+"""
+Binary fingerprint files. A 64 byte header holds the format version, the
+fpType parameters and the array lengths; the peaks, strongest quads and
+hashes follow as little-endian arrays at 64 byte aligned offsets, so a
+fingerprint can be memory-mapped instead of read:
+
+    magic 'QFPF', version (u16), 0 (u16), q r c w h (5 x i32),
+    number of peaks (i64), number of quads (i64), padding
+    peaks      (N,2) int32
+    strongest  (M,8) int32
+    hashes     (M,4) float32
+"""
+
+MAGIC = b'QFPF'
+VERSION = 1
+HEADER = struct.Struct('<4sHH5iqq')
+ALIGN = 64
+
+FINGERPRINTS = {fpType.Reference: ReferenceFingerprint,
+                fpType.Query: QueryFingerprint}
+
+
+def save_fingerprint(fp, path):
+    """
+    Writes peaks, strongest quads and hashes of fp to path. The file is
+    written under a temporary name first, so readers never see a
+    partial fingerprint.
+    """
+    arrays = (as_peaks(fp.peaks), as_quads(fp.strongest),
+              as_hashes(fp.hashes))
+    header = HEADER.pack(MAGIC, VERSION, 0, *(tuple(fp.params) +
+                                              (len(arrays[0]),
+                                               len(arrays[1]))))
+    directory = os.path.dirname(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        with f:
+            f.write(_pad(header))
+            for arr in arrays:
+                f.write(_pad(arr.astype(arr.dtype.newbyteorder('<'),
+                                        copy=False).tobytes()))
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def load_fingerprint(path, mmap_mode='r'):
+    """
+    Reads a fingerprint written by save_fingerprint. Its arrays are
+    memory-mapped unless mmap_mode is None.
+    Returns: ReferenceFingerprint or QueryFingerprint, with path None
+    """
+    params, peaks, strongest, hashes = _read(path, mmap_mode)
+    if params not in FINGERPRINTS:
+        raise ValueError("Unknown fingerprint parameters %s in %s"
+                         % (params, path))
+    fp = FINGERPRINTS[params](None)
+    fp.peaks, fp.strongest, fp.hashes = peaks, strongest, hashes
+    return fp
+
+
+def _read(path, mmap_mode='r'):
+    """
+    Returns: (fpType parameters, peaks, strongest, hashes) of a
+    fingerprint file
+    """
+    if mmap_mode is None:
+        with open(path, 'rb') as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+    else:
+        buf = np.memmap(path, dtype=np.uint8, mode=mmap_mode)
+    if len(buf) < HEADER.size:
+        raise ValueError("%s is not a fingerprint file" % path)
+    fields = HEADER.unpack(buf[:HEADER.size].tobytes())
+    magic, version = fields[:2]
+    if magic != MAGIC:
+        raise ValueError("%s is not a fingerprint file" % path)
+    if version != VERSION:
+        raise ValueError("Unsupported fingerprint version %d in %s"
+                         % (version, path))
+    params, n, m = tuple(fields[3:8]), fields[8], fields[9]
+    arrays = []
+    offset = _aligned(HEADER.size)
+    for dtype, count in (('<i4', n * 2), ('<i4', m * 8), ('<f4', m * 4)):
+        size = count * 4
+        if offset + size > len(buf):
+            raise ValueError("%s is truncated" % path)
+        arrays.append(np.asarray(buf[offset:offset + size]).view(dtype))
+        offset = _aligned(offset + size)
+    peaks, strongest, hashes = arrays
+    return params, as_peaks(peaks), as_quads(strongest), as_hashes(hashes)
+
+
+def _aligned(size):
+    return -(-size // ALIGN) * ALIGN
+
+
+def _pad(data):
+    return data + b'\0' * (_aligned(len(data)) - len(data))
+
+
+class Storage:
+    """
+    Size-bounded cache of fingerprint files in a directory, keyed by a
+    hash of the audio content and the fingerprint parameters. Pass it
+    to Fingerprint.create to load the fingerprint on a cache hit:
+
+        cache = Storage('fingerprints')
+        fp = ReferenceFingerprint('song.mp3')
+        fp.create(cache=cache)
+
+    When the files take more than max_size bytes, the least recently
+    used are evicted. Several processes may share a cache directory.
+    """
+    SUFFIX = '.qfp'
+
+    def __init__(self, path, max_size=1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, source, params, snip=None):
+        """
+        Returns cache key of the audio source (a path, bytes or an array
+        of samples) fingerprinted with params and snip, or None for
+        file objects, which can not be hashed without consuming them
+        """
+        content = hashlib.sha1()
+        if isinstance(source, np.ndarray):
+            content.update(np.ascontiguousarray(source, np.int16).tobytes())
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            content.update(source)
+        elif hasattr(source, 'read'):
+            return None
+        else:
+            with open(source, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    content.update(block)
+        spec = repr((VERSION, tuple(params), snip)).encode('ascii')
+        return hashlib.sha1(content.digest() + spec).hexdigest()
+
+    def restore(self, fp, key):
+        """
+        Loads the arrays of fp from the cache file of key.
+        Returns: True on a hit, False otherwise
+        """
+        path = self._file(key)
+        try:
+            _, fp.peaks, fp.strongest, fp.hashes = _read(path)
+            fp.ranks = None
+            os.utime(path, None)  # most recently used
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, fp, key):
+        """
+        Writes the arrays of fp to the cache file of key, then evicts
+        the least recently used files above max_size
+        """
+        save_fingerprint(fp, self._file(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used files until the cache takes at most
+        max_size bytes
+        """
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:  # evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
@@ -0,0 +1,201 @@
+from __future__ import division
+
+import numpy as np
+from scipy.ndimage import maximum_filter, minimum_filter
+
+from .audio import stream_audio
+from .quads import quad_indices
+from .utils import (as_peaks, as_quads, nlargest_indices, generate_hash,
+                    Spectrogram)
+
+"""
+Streaming versions of the fingerprinting stages. Each stage consumes
+the chunks yielded by the previous one and keeps only the context it
+needs, so memory use stays constant for recordings of any length.
+Given the same samples, the concatenated output of every stage is
+identical to the batch functions in qfp.utils and qfp.quads.
+"""
+
+
+def stream_spectrogram(blocks, framesize=1024, hopsize=32):
+    """
+    Yields consecutive row chunks of the spectrogram that stft would
+    return for the concatenation of the sample blocks
+    """
+    engine = Spectrogram(framesize, hopsize)
+    buf = np.zeros(int(framesize / 2), dtype=np.float32)
+    total = len(buf)  # padded samples seen so far
+    for block in blocks:
+        buf = np.append(buf, block)
+        total += len(block)
+        cols = (len(buf) - framesize) // hopsize + 1
+        if cols <= 0:
+            continue
+        yield engine.frames(buf, cols)
+        buf = buf[cols * hopsize:]
+    # same number of frames and trailing zero padding as stft
+    consumed = total - len(buf)
+    cols = int(np.ceil((total - framesize) / float(hopsize)) + 1)
+    cols -= consumed // hopsize
+    if cols > 0:
+        buf = np.append(buf, np.zeros(framesize, dtype=np.float32))
+        yield engine.frames(buf, cols)
+
+
+def stream_peaks(chunks, maxWidth, maxHeight, minWidth=3, minHeight=3):
+    """
+    Yields (PeakArray, magnitudes) for consecutive spectrogram chunks.
+    Peak x values are frame numbers from the start of the stream and
+    magnitudes holds the spectrogram value at every peak. Enough frames
+    are kept on both sides of each chunk that the filters only see the
+    recording's real borders, which they reflect like find_peaks does.
+    """
+    pad = max(maxWidth, minWidth)
+    maxFootprint = np.ones((maxWidth, maxHeight), dtype=np.int8)
+    minFootprint = np.ones((minWidth, minHeight), dtype=np.int8)
+    buf = None
+    start = 0  # frame number of buf[0]
+    done = 0  # frames whose peaks have been yielded
+    for chunk in chunks:
+        buf = chunk if buf is None else np.concatenate((buf, chunk))
+        end = start + len(buf) - pad
+        if end > done:
+            yield _chunk_peaks(buf, start, done, end,
+                               maxFootprint, minFootprint)
+            done = end
+            # keep pad frames of context before the next chunk
+            drop = done - pad - start
+            if drop > 0:
+                buf = buf[drop:]
+                start += drop
+    if buf is not None and start + len(buf) > done:
+        yield _chunk_peaks(buf, start, done, start + len(buf),
+                           maxFootprint, minFootprint)
+
+
+def _chunk_peaks(buf, start, first, end, maxFootprint, minFootprint):
+    """
+    Returns peaks (and their magnitudes) of frames [first, end) of the
+    spectrogram rows in buf, which begin at frame start
+    """
+    maxima = maximum_filter(buf, footprint=maxFootprint)
+    minima = minimum_filter(buf, footprint=minFootprint)
+    sl = slice(first - start, end - start)
+    peaks = ((buf[sl] == maxima[sl]) == (maxima[sl] != minima[sl]))
+    x, y = np.nonzero(peaks)
+    magnitudes = buf[sl][x, y]
+    return as_peaks(np.column_stack((x + first, y))), magnitudes
+
+
+def stream_quads(chunks, r, c):
+    """
+    Yields (QuadArray, strength) for consecutive (PeakArray, magnitudes)
+    chunks, as soon as every peak in the window of a root has been
+    seen. strength is the sum of the magnitudes of C and D, which
+    n_strongest ranks quads by.
+    """
+    peaks = as_peaks([])
+    # float32 like the spectrogram: n_strongest sums strengths in float32
+    magnitudes = np.empty(0, dtype=np.float32)
+    first = 0  # buffered peaks before first are done being roots
+    for new, newMagnitudes in chunks:
+        peaks = as_peaks(np.concatenate((peaks, new)))
+        magnitudes = np.concatenate((magnitudes, newMagnitudes))
+        if first == len(peaks):
+            continue
+        # roots whose window ends at or before the last peak are complete
+        windowEnd = peaks[first:].x + c - (r / 2) + r
+        ready = first + np.searchsorted(windowEnd, peaks[-1].x, side='right')
+        if ready == first:
+            continue
+        yield _strength(peaks, magnitudes, np.arange(first, ready), r, c)
+        # later roots only use peaks from their own window onwards
+        nextRoot = peaks[min(ready, len(peaks) - 1)].x
+        drop = min(ready, np.searchsorted(peaks.x, nextRoot + c - (r / 2)))
+        peaks, magnitudes = peaks[drop:], magnitudes[drop:]
+        first = ready - drop
+    if first < len(peaks):
+        yield _strength(peaks, magnitudes, np.arange(first, len(peaks)), r, c)
+
+
+def _strength(peaks, magnitudes, roots, r, c):
+    """
+    Returns quads of the given roots and the summed magnitudes of
+    their C and D
+    """
+    a, cdb = quad_indices(peaks, roots, r, c)
+    quads = np.empty((len(a), 8), dtype=np.int32)
+    quads[:, 0:2] = peaks[a]
+    quads[:, 2:8] = peaks[cdb].reshape(-1, 6)
+    return as_quads(quads), magnitudes[cdb[:, 0]] + magnitudes[cdb[:, 1]]
+
+
+def stream_strongest(chunks, n, l=250):
+    """
+    Yields the n strongest quads of each 1 second (l frames) partition
+    for consecutive (QuadArray, strength) chunks, like n_strongest.
+    A partition is complete once a quad two partitions later has been
+    seen, since the last partition of a recording also takes the
+    quads after it.
+    """
+    quads = as_quads([])
+    strength = np.empty(0, dtype=np.float32)
+    k = 0  # next partition
+    last = 0
+    for newQuads, newStrength in chunks:
+        if len(newQuads) == 0:
+            continue
+        quads = as_quads(np.concatenate((quads, newQuads)))
+        strength = np.concatenate((strength, newStrength))
+        last = quads[-1].A.x
+        while (k + 2) * l <= last:
+            end = np.searchsorted(quads.A.x, (k + 1) * l)
+            yield quads[nlargest_indices(strength[:end], n)]
+            quads, strength = quads[end:], strength[end:]
+            k += 1
+    numPartitions = last // l
+    for j in range(k, numPartitions):
+        if j < numPartitions - 1:
+            end = np.searchsorted(quads.A.x, (j + 1) * l)
+        else:
+            end = len(quads)
+        yield quads[nlargest_indices(strength[:end], n)]
+        quads, strength = quads[end:], strength[end:]
+
+
+def stream_fingerprint(blocks, fp_type, blocksize=80000):
+    """
+    Fingerprints a stream of sample blocks (or the path of an audio
+    file, read with stream_audio) in constant memory.
+    Yields: (peaks, strongest, hashes) chunks
+    """
+    q, r, c, w, h = fp_type
+    if isinstance(blocks, str):
+        blocks = stream_audio(blocks, blocksize)
+    peaks = PeakTap(stream_peaks(stream_spectrogram(blocks), w, h))
+    for strongest in stream_strongest(stream_quads(peaks, r, c), q):
+        yield peaks.flush(), strongest, generate_hash(strongest)
+    rest = peaks.flush()
+    if len(rest):
+        yield rest, as_quads([]), generate_hash(as_quads([]))
+
+
+class PeakTap:
+    """
+    Passes (peaks, magnitudes) chunks through and keeps the peaks
+    until they are flushed
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.peaks = []
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.peaks.append(chunk[0])
+            yield chunk
+
+    def flush(self):
+        peaks = as_peaks(np.concatenate(self.peaks + [as_peaks([])]))
+        self.peaks = []
+        return peaks
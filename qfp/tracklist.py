@@ -0,0 +1,111 @@
+from __future__ import division
+from collections import namedtuple
+import numpy as np
+
+from .audio import stream_audio
+from .fingerprint import fpType, QueryFingerprint
+from .stream import stream_spectrogram, stream_peaks, stream_quads, PeakTap
+from .utils import as_peaks, as_quads, select_strongest, generate_hash
+
+# spectrogram frames per second (8 kHz audio, hop size of 32 samples)
+FRAMES_PER_SECOND = 250
+
+Segment = namedtuple('Segment', ['record', 'start', 'end', 'offset',
+                                 'vScore'])
+
+
+def tracklist(db, audio, window=15, hop=5, vThreshold=0.5, gap=1):
+    """
+    Identifies the tracks of a long recording such as a DJ set.
+    Consecutive windows matching the same record are merged into a
+    Segment, tolerating up to gap unmatched windows in between.
+    Segment start/end are seconds into the recording, offset is the
+    position (in seconds) in the record where the segment starts.
+    Returns: list of Segments
+    """
+    segments = []
+    current, missed = None, 0
+    for start, matches in identify_windows(db, audio, window, hop,
+                                           vThreshold):
+        best = max(matches, key=lambda m: m.vScore) if matches else None
+        if best is not None and current is not None \
+                and best.record == current.record:
+            current = current._replace(
+                end=start + window, vScore=max(current.vScore, best.vScore))
+            missed = 0
+            continue
+        if best is None and current is not None and missed < gap:
+            missed += 1
+            continue
+        if current is not None:
+            segments.append(current)
+        current, missed = None, 0
+        if best is not None:
+            current = Segment(best.record, start, start + window,
+                              best.offset / FRAMES_PER_SECOND, best.vScore)
+    if current is not None:
+        segments.append(current)
+    return segments
+
+
+def identify_windows(db, audio, window=15, hop=5, vThreshold=0.5,
+                     blocksize=80000):
+    """
+    Fingerprints audio (a path or an iterable of sample blocks) once
+    in streaming fashion and queries db with overlapping windows of
+    window seconds, every hop seconds. Peaks and quads are computed
+    once and shared by all windows that contain them; only the
+    strongest quad selection is done per window.
+    Yields: (window start in seconds, list of Matches)
+    """
+    q, r, c, w, h = fpType.Query
+    W = int(window * FRAMES_PER_SECOND)
+    H = int(hop * FRAMES_PER_SECOND)
+    if isinstance(audio, str):
+        audio = stream_audio(audio, blocksize)
+    tap = PeakTap(stream_peaks(stream_spectrogram(audio), w, h))
+    peaks = as_peaks([])
+    quads = as_quads([])
+    strength = np.empty(0)
+    t0 = 0
+    for newQuads, newStrength in stream_quads(tap, r, c):
+        peaks = as_peaks(np.concatenate((peaks, tap.flush())))
+        quads = as_quads(np.concatenate((quads, newQuads)))
+        strength = np.concatenate((strength, newStrength))
+        if len(peaks) == 0:
+            continue
+        # quads of every root up to here have been found
+        frontier = peaks[-1].x - (c + r / 2)
+        while t0 + W <= frontier:
+            yield t0 / FRAMES_PER_SECOND, _query_window(
+                db, peaks, quads, strength, t0, W, q, vThreshold)
+            t0 += H
+            keep = quads.A.x >= t0
+            quads, strength = quads[keep], strength[keep]
+            peaks = peaks[peaks.x >= t0]
+    peaks = as_peaks(np.concatenate((peaks, tap.flush())))
+    end = peaks[-1].x + 1 if len(peaks) else 0
+    while t0 < end and (t0 == 0 or t0 + W - H < end):
+        yield t0 / FRAMES_PER_SECOND, _query_window(
+            db, peaks, quads, strength, t0, W, q, vThreshold)
+        t0 += H
+
+
+def _query_window(db, peaks, quads, strength, t0, W, q, vThreshold):
+    """
+    Queries db with the peaks and quads inside frames [t0, t0 + W),
+    shifted to start at 0 like a query clip of that window
+    Returns: list of Matches
+    """
+    inside = (quads.A.x >= t0) & (quads.B.x < t0 + W)
+    windowQuads = np.array(quads[inside])
+    windowQuads[:, ::2] -= t0
+    windowPeaks = np.array(peaks[(peaks.x >= t0) & (peaks.x < t0 + W)])
+    windowPeaks[:, 0] -= t0
+    fp = QueryFingerprint(None)
+    fp.peaks = as_peaks(windowPeaks)
+    fp.strongest, fp.ranks = select_strongest(windowQuads, strength[inside],
+                                              q, return_ranks=True)
+    fp.hashes = generate_hash(fp.strongest)
+    db.query(fp, vThreshold)
+    return fp.matches
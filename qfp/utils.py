@@ -2,11 +2,77 @@ from __future__ import division
 
 import numpy as np
 from numpy.lib import stride_tricks
-from scipy.ndimage.filters import maximum_filter, minimum_filter
-from bisect import bisect_left
-from collections import namedtuple
-from itertools import izip
-from heapq import nlargest
+from scipy.ndimage import maximum_filter, minimum_filter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+try:
+    from scipy.fft import rfft  # transforms float32 in single precision
+except ImportError:
+    from numpy.fft import rfft
+
+# Spectrogram engines of each thread, used by stft
+_engines = threading.local()
+
+
+class PeakArray(np.ndarray):
+    """
+    (N,2) int32 array of peaks. Columns are x (time) and y (frequency)
+    and can be read as attributes, like the old Peak namedtuple.
+    """
+
+    @property
+    def x(self):
+        return self[..., 0]
+
+    @property
+    def y(self):
+        return self[..., 1]
+
+
+class QuadArray(np.ndarray):
+    """
+    (M,8) int32 array of quads with columns Ax,Ay,Cx,Cy,Dx,Dy,Bx,By.
+    Points can be read as PeakArray attributes, like the old Quad
+    namedtuple (e.g. quads.A.x is the column of root x values).
+    """
+
+    @property
+    def A(self):
+        return self[..., 0:2].view(PeakArray)
+
+    @property
+    def C(self):
+        return self[..., 2:4].view(PeakArray)
+
+    @property
+    def D(self):
+        return self[..., 4:6].view(PeakArray)
+
+    @property
+    def B(self):
+        return self[..., 6:8].view(PeakArray)
+
+
+def as_peaks(peaks):
+    """
+    Returns peaks as (N,2) int32 PeakArray
+    """
+    return np.asarray(peaks, dtype=np.int32).reshape(-1, 2).view(PeakArray)
+
+
+def as_quads(quads):
+    """
+    Returns quads as (M,8) int32 QuadArray
+    """
+    return np.asarray(quads, dtype=np.int32).reshape(-1, 8).view(QuadArray)
+
+
+def as_hashes(hashes):
+    """
+    Returns hashes as (M,4) float32 array
+    """
+    return np.asarray(hashes, dtype=np.float32).reshape(-1, 4)
 
 
 def stft(samples, framesize=1024, hopsize=32):
@@ -14,81 +80,282 @@ def stft(samples, framesize=1024, hopsize=32):
     Short time fourier transform of audio
     Framesize of 1024 samples (128ms) and
     Hopsize of 32 samples (4ms) as per Sonnleitner/Widmer paper
-    Returns: 2D numpy array of float64 values
-    """
-    window = np.hanning(framesize)
-    samples = np.append(np.zeros(int(framesize / 2)), samples)
-    cols = int(np.ceil((len(samples) - framesize) / float(hopsize)) + 1)
-    samples = np.append(samples, np.zeros(framesize))
-    strides = (samples.strides[0] * hopsize, samples.strides[0])
-    frames = stride_tricks.as_strided(samples,
-                                      shape=(cols, framesize),
-                                      strides=strides).copy()
-    frames *= window
-    spec = np.fft.rfft(frames)
+    Computed in float32 by the calling thread's Spectrogram, see there
+    for its accuracy.
+    Returns: 2D numpy array of float32 values
+    """
+    engines = _engines.__dict__.setdefault('engines', {})
+    key = (framesize, hopsize)
+    if key not in engines:
+        engines[key] = Spectrogram(framesize, hopsize)
+    return engines[key](samples)
+
+
+class Spectrogram:
+    """
+    Float32 spectrogram engine. Frames are strided views of the samples
+    (zero padded by framesize / 2 on both sides, as if the signal was
+    padded). block of them at a time are windowed into a preallocated
+    work buffer and transformed with a real FFT. Magnitude and decibel
+    conversion happen in place in the output. The whole frame matrix is
+    never materialized, and the samples are only copied for the few
+    frames that overlap the padding.
+
+    Compared to a float64 transform, values within 60 dB of the loudest
+    bin of their frame differ by less than 1e-3 dB, and values within
+    100 dB by less than 0.05 dB. Further below, float32 round-off
+    dominates. On music find_peaks finds the same peaks but for rare
+    near-ties (at most 0.5% of the peaks of a recording in our tests);
+    on synthetic pure tones, peaks in the leakage floor far below the
+    tone may differ.
+
+    The work buffer is reused by every call, so an instance must not be
+    shared between threads.
+    """
+
+    def __init__(self, framesize=1024, hopsize=32, block=256):
+        self.framesize = framesize
+        self.hopsize = hopsize
+        self.block = block
+        self.window = np.hanning(framesize).astype(np.float32)
+        self._frames = np.empty((block, framesize), dtype=np.float32)
+
+    def __call__(self, samples):
+        """
+        Returns: (frames, framesize / 2 + 1) float32 spectrogram of
+        samples, zero padded by framesize / 2 on both sides
+        """
+        samples = np.asarray(samples)
+        n, pad, hop = len(samples), self.framesize // 2, self.hopsize
+        cols = max(int(np.ceil((pad + n - self.framesize) / hop) + 1), 0)
+        out = np.empty((cols, self.framesize // 2 + 1), dtype=np.float32)
+        # frames [first, stop) lie inside the samples, the others overlap
+        # the padding
+        first = min(-(-pad // hop), cols)
+        stop = max(first, min(cols, (n - self.framesize + pad) // hop + 1))
+        self._transform(self._padded_frames(samples, 0, first),
+                        out[:first])
+        self._transform(self._view(samples[first * hop - pad:],
+                                   stop - first), out[first:stop])
+        self._transform(self._padded_frames(samples, stop, cols),
+                        out[stop:])
+        return out
+
+    def frames(self, samples, cols):
+        """
+        Returns: float32 spectrogram of the cols frames starting at the
+        first of samples, which must be padded already
+        """
+        out = np.empty((cols, self.framesize // 2 + 1), dtype=np.float32)
+        self._transform(self._view(samples, cols), out)
+        return out
+
+    def _view(self, samples, cols):
+        """
+        Returns (cols, framesize) view of the overlapping frames of
+        samples
+        """
+        strides = (samples.strides[0] * self.hopsize, samples.strides[0])
+        return stride_tricks.as_strided(samples,
+                                        shape=(cols, self.framesize),
+                                        strides=strides)
+
+    def _padded_frames(self, samples, start, stop):
+        """
+        Returns view of the frames start to stop of samples zero padded
+        by framesize / 2, copying only the samples they cover
+        """
+        if stop <= start:
+            return np.empty((0, self.framesize), dtype=np.float32)
+        lo = start * self.hopsize - self.framesize // 2
+        hi = lo + (stop - start - 1) * self.hopsize + self.framesize
+        piece = np.zeros(hi - lo, dtype=np.float32)
+        a, b = max(lo, 0), min(hi, len(samples))
+        if b > a:
+            piece[a - lo:b - lo] = samples[a:b]
+        return self._view(piece, stop - start)
+
+    def _transform(self, frames, out):
+        """
+        Writes the decibel magnitude spectrum of frames to out
+        """
+        for start in range(0, len(frames), self.block):
+            rows = frames[start:start + self.block]
+            windowed = self._frames[:len(rows)]
+            np.multiply(rows, self.window, out=windowed)
+            _decibels(rfft(windowed), out[start:start + len(rows)])
+
+
+def _decibels(spec, out):
+    """
+    Converts complex spectrum to decibel magnitudes, in place in out
+    """
+    np.abs(spec, out=out)
+    out /= 10e-6
     with np.errstate(divide='ignore'):  # silences "divide by zero" error
-        spec = 20. * np.log10(np.abs(spec) / 10e-6)  # amplitude to decibel
-    spec[spec == -np.inf] = 0
-    return spec
+        np.log10(out, out=out)  # amplitude to decibel
+    out *= 20.
+    out[np.isneginf(out)] = 0
 
 
-def find_peaks(spec, maxWidth, maxHeight, minWidth=3, minHeight=3):
+def find_peaks(spec, maxWidth, maxHeight, minWidth=3, minHeight=3,
+               workers=1, tile=4096):
     """
     Calculate peaks of spectrogram using maximum filter
     Local minima used to filter out uniform areas (e.g. silence)
-    Returns: list of namedtuple Peaks
+    The spectrogram is filtered in tiles of tile frames (plus the frames
+    the filter window reaches into), in workers threads. The minimum is
+    only taken around the points equal to their neighborhood maximum.
+    Returns: PeakArray sorted by x, then y
+    """
+    spec = np.asarray(spec)
+    starts = range(0, len(spec), tile)
+
+    def peaks(start):
+        return _tile_peaks(spec, start, min(start + tile, len(spec)),
+                           (maxWidth, maxHeight), (minWidth, minHeight))
+
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            tiles = list(pool.map(peaks, starts))
+    else:
+        tiles = [peaks(start) for start in starts]
+    return as_peaks(np.concatenate(tiles + [np.empty((0, 2), np.int32)]))
+
+
+def _tile_peaks(spec, start, stop, maxSize, minSize):
     """
-    Peak = namedtuple('Peak', ['x', 'y'])
-    maxFilterDimen = (maxWidth, maxHeight)
-    minFilterDimen = (minWidth, minHeight)
-    maxima = maximum_filter(spec, footprint=np.ones(
-        maxFilterDimen, dtype=np.int8))
-    minima = minimum_filter(spec, footprint=np.ones(
-        minFilterDimen, dtype=np.int8))
-    peaks = ((spec == maxima) == (maxima != minima))
-    # todo: parabolic interpolation
-    x, y = np.nonzero(peaks)
-    namedpeaks = [Peak(p[0], p[1]) for p in izip(x, y)]
-    return namedpeaks
+    Returns: (N,2) array of the peaks of frames start to stop of spec
+    """
+    # maximum_filter centers its window at size // 2
+    lo = max(start - maxSize[0] // 2, 0)
+    hi = min(stop + maxSize[0] - 1 - maxSize[0] // 2, len(spec))
+    maxima = maximum_filter(spec[lo:hi], size=maxSize)[start - lo:stop - lo]
+    x, y = np.nonzero(spec[start:stop] == maxima)
+    maxima = maxima[x, y]
+    x += start
+    if len(x) * minSize[0] * minSize[1] > (stop - start) * spec.shape[1]:
+        # mostly flat tile: cheaper to filter it all
+        lo = max(start - minSize[0] // 2, 0)
+        hi = min(stop + minSize[0] - 1 - minSize[0] // 2, len(spec))
+        minima = minimum_filter(spec[lo:hi], size=minSize)[x - lo, y]
+    else:
+        minima = _minima_at(spec, x, y, minSize)
+    # equal to the maximum, and not in an area of uniform values
+    keep = maxima != minima
+    return np.column_stack((x[keep], y[keep])).astype(np.int32)
+
+
+def _minima_at(spec, x, y, size):
+    """
+    Returns minimum_filter(spec, size) at the points (x, y)
+    """
+    dx = _reflect(x[:, None] + np.arange(size[0]) - size[0] // 2, len(spec))
+    dy = _reflect(y[:, None] + np.arange(size[1]) - size[1] // 2,
+                  spec.shape[1])
+    return spec[dx[:, :, None], dy[:, None, :]].min(axis=(1, 2))
 
 
-def n_strongest(spec, quads, n):
+def _reflect(idx, n):
     """
-    Returns list of n strongest quads in each 1 second partition
+    Maps indices outside [0, n) into it like the filters' reflect mode
+    (d c b a | a b c d | d c b a)
+    """
+    idx = idx % (2 * n)
+    return np.where(idx >= n, 2 * n - 1 - idx, idx)
+
+
+def n_strongest(spec, quads, n, return_ranks=False):
+    """
+    Returns QuadArray of n strongest quads in each 1 second partition
+    (and their ranks, see select_strongest)
     Strongest is calculated by magnitudes of C and D in quad
     """
-    strongest = []
-    partitions = _find_partitions(quads)
-    key = lambda p: (spec[p.C.x][p.C.y] + spec[p.D.x][p.D.y])
-    for i in xrange(1, len(partitions)):
-        start = partitions[i - 1]
-        end = partitions[i]
-        strongest += nlargest(n, quads[start:end], key)
+    quads = as_quads(quads)
+    strength = spec[quads.C.x, quads.C.y] + spec[quads.D.x, quads.D.y]
+    return select_strongest(quads, strength, n, return_ranks)
+
+
+def select_strongest(quads, strength, n, return_ranks=False):
+    """
+    Returns QuadArray of the n quads with the highest strength in each
+    1 second partition, partition by partition, strongest first (ties
+    keep their original order). With return_ranks, also returns the
+    rank of every selected quad within its partition (0 for the
+    strongest), as strength_ranks does.
+    """
+    quads = as_quads(quads)
+    strength = np.asarray(strength)
+    partition = _partition_of(quads.A.x, num_partitions(quads))
+    keep = np.flatnonzero(partition >= 0)
+    # stable: within a partition ties stay in their original order
+    order = keep[np.lexsort((-strength[keep], partition[keep]))]
+    partition = partition[order]
+    ranks = np.arange(len(order)) - np.searchsorted(partition, partition)
+    strongest = quads[order[ranks < n]]
+    if return_ranks:
+        return strongest, ranks[ranks < n]
     return strongest
 
 
-def _find_partitions(quads, l=250):
+def nlargest_indices(strength, n):
+    """
+    Returns indices of the n largest values of strength in descending
+    order (ties keep their original order)
+    """
+    return np.argsort(-np.asarray(strength), kind='stable')[:n]
+
+
+def strength_ranks(strongest, numPartitions, l=250):
+    """
+    Returns rank of every quad selected by n_strongest by strength
+    within its partition (0 for the strongest). numPartitions is the
+    num_partitions of all the quads they were selected from: the last
+    partition also takes the quads after it, which are ordered by
+    strength, not time.
+    """
+    partition = _partition_of(as_quads(strongest).A.x, numPartitions, l)
+    return np.arange(len(partition)) - np.searchsorted(partition, partition)
+
+
+def num_partitions(quads, l=250):
+    """
+    Returns number of 1 second (l frames) partitions the strongest
+    quads are selected from, of quads sorted by A.x
+    """
+    return int(quads[-1].A.x // l) if len(quads) else 0
+
+
+def _partition_of(ax, numPartitions, l=250):
+    """
+    Returns index of the 1 second (l frames) partition of every A.x.
+    The last partition takes the quads after it, and quads of
+    recordings shorter than one partition get -1.
+    """
+    return np.minimum(np.asarray(ax) // l, numPartitions - 1).astype(np.int64)
+
+
+def generate_hash(quads):
     """
-    Returns list of indices where partitions of 250 (1 second) are
+    Compute translation- and scale-invariant hashes from given quads
+    (a single quad or an (M,8) array)
+    Returns: hashes as float32 (cDash.x, cDash.y, dDash.x, dDash.y)
     """
-    b_l = bisect_left
-    last_x = quads[-1].A.x
-    num_partitions = last_x // l
-    # creates a tuple of same form as the Quad namedtuple for bisecting
-    q = lambda x: ((x,), (), (), ())
-    partitions = [b_l(quads, q(i * l)) for i in xrange(num_partitions)]
-    partitions.append(len(quads))
-    return partitions
+    quads = np.asarray(quads, dtype=np.float64)
+    A, C, D, B = (quads[..., i:i + 2] for i in (0, 2, 4, 6))
+    B = B - A
+    cDash = (C - A) / B
+    dDash = (D - A) / B
+    return np.concatenate((cDash, dDash), axis=-1).astype(np.float32)
 
 
-def generate_hash(quad):
+def expand_ranges(starts, stops):
     """
-    Compute translation- and scale-invariant hash from a given quad
+    Expands half-open index ranges [start, stop) into flat indices.
+    Returns: (number of the range each index belongs to, index)
     """
-    A, C, D, B = quad
-    B = (B.x - A.x, B.y - A.y)
-    C = (C.x - A.x, C.y - A.y)
-    D = (D.x - A.x, D.y - A.y)
-    cDash = (C[0] / B[0], C[1] / B[1])
-    dDash = (D[0] / B[0], D[1] / B[1])
-    return cDash + dDash
+    lengths = stops - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    idx = np.arange(lengths.sum()) - offsets[owner] + starts[owner]
+    return owner, idx
@@ -11,7 +11,6 @@ setup(
   keywords = ['audio', 'fingerprinting'],
   classifiers = [],
   install_requires=[
-    'pydub',
     'numpy',
     'scipy',
     'bitstring'
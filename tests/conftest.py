@@ -0,0 +1,88 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from benchmarks.synth import (SAMPLE_RATE, track, noise, add_noise,
+                              change_speed)
+from qfp import ReferenceFingerprint, QueryFingerprint
+from qfp.db import QfpDB
+
+
+@pytest.fixture(scope='session')
+def catalog():
+    """
+    Reference fingerprints by title, in the order to store them. partial
+    holds excerpts of the other tracks, so clips match several records.
+    """
+    tracks = [track(30, seed) for seed in (1, 2, 3)]
+    samples = OrderedDict()
+    samples['partial'] = np.concatenate([
+        tracks[1][:10 * SAMPLE_RATE],
+        tracks[0][8 * SAMPLE_RATE:14 * SAMPLE_RATE],
+        tracks[2][:14 * SAMPLE_RATE]])
+    for i, t in enumerate(tracks):
+        samples['track %d' % (i + 1)] = t
+    fps = OrderedDict()
+    for title, s in samples.items():
+        fps[title] = ReferenceFingerprint(s)
+        fps[title].create()
+    return fps
+
+
+@pytest.fixture(scope='session')
+def clip_samples():
+    t1, t3 = track(30, 1), track(30, 3)
+    return OrderedDict([
+        ('track 1', add_noise(t1[6 * SAMPLE_RATE:21 * SAMPLE_RATE], 20)),
+        ('track 1 faster', add_noise(change_speed(
+            t1[6 * SAMPLE_RATE:21 * SAMPLE_RATE], 1.05), 20)),
+        ('track 3', add_noise(t3[10 * SAMPLE_RATE:25 * SAMPLE_RATE], 20)),
+        ('no match', noise(15, 5))])
+
+
+@pytest.fixture
+def clips(clip_samples):
+    """
+    New query fingerprints of the clips by name: queries set their
+    matches
+    """
+    fps = OrderedDict()
+    for name, samples in clip_samples.items():
+        fps[name] = QueryFingerprint(samples)
+        fps[name].create()
+    return fps
+
+
+
+@pytest.fixture(scope='session')
+def query_all(clip_samples):
+    """
+    Returns function that queries a db with every clip, scoring all
+    candidates (vThreshold=0).
+    Returns: list of (sorted matches, sorted candidates without their
+    recordids, which differ between backends) of every clip
+    """
+    def query_all(db):
+        results = []
+        for samples in clip_samples.values():
+            fp = QueryFingerprint(samples)
+            fp.create()
+            db.query(fp, vThreshold=0)
+            results.append((sorted(fp.matches), sorted(
+                mc[1:] for mc in fp.match_candidates)))
+        return results
+    return query_all
+
+
+@pytest.fixture(scope='session')
+def expected(tmp_path_factory, catalog, query_all):
+    """
+    query_all results of the catalog stored in a plain R-tree QfpDB
+    """
+    db = QfpDB(str(tmp_path_factory.mktemp('expected') / 'qfp.db'))
+    db.store_many((fp, title) for title, fp in catalog.items())
+    results = query_all(db)
+    # every clip but the last matches
+    assert [bool(m) for m, _ in results] == [True, True, True, False]
+    return results
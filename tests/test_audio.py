@@ -0,0 +1,149 @@
+import io
+import mmap
+import struct
+import sys
+
+import numpy as np
+import pytest
+
+from qfp import audio
+
+
+def _stub_ffmpeg(monkeypatch, script):
+    """
+    Replaces ffmpeg by a python script
+    """
+    monkeypatch.setattr(audio, '_ffmpeg_command',
+                        lambda *args: [sys.executable, '-c', script])
+
+
+@pytest.fixture
+def mp3(tmp_path):
+    path = tmp_path / 'clip.mp3'
+    path.write_bytes(b'not a wav file')
+    return str(path)
+
+
+def test_stream_audio(monkeypatch, mp3):
+    _stub_ffmpeg(monkeypatch, "import sys; "
+                 "sys.stdout.buffer.write(bytes(range(20)))")
+    blocks = list(audio.stream_audio(mp3, blocksize=4))
+    assert [len(b) for b in blocks] == [4, 4, 2]
+    assert np.concatenate(blocks).tobytes() == bytes(range(20))
+
+
+def test_stream_audio_raises_on_decode_error(monkeypatch, mp3):
+    _stub_ffmpeg(monkeypatch, "import sys; "
+                 "sys.stdout.buffer.write(bytes(8)); sys.stdout.flush(); "
+                 "sys.stderr.write('Invalid data found'); sys.exit(1)")
+    with pytest.raises(IOError, match='Invalid data found'):
+        list(audio.stream_audio(mp3))
+
+
+def test_stream_audio_stopped_early(monkeypatch, mp3):
+    _stub_ffmpeg(monkeypatch, "import sys\n"
+                 "while True: sys.stdout.buffer.write(bytes(4096))")
+    blocks = audio.stream_audio(mp3, blocksize=100)
+    assert len(next(blocks)) == 100
+    blocks.close()
+
+
+def _wav(samples, rate=8000, channels=1, extra=b''):
+    """
+    Returns bytes of a 16-bit PCM WAV file, with chunk extra before
+    its data
+    """
+    data = samples.astype('<i2').tobytes()
+    fmt = struct.pack('<HHIIHH', 1, channels, rate, rate * channels * 2,
+                      channels * 2, 16)
+    chunks = (b'fmt ' + struct.pack('<I', len(fmt)) + fmt + extra +
+              b'data' + struct.pack('<I', len(data)) + data)
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+
+def _mapped(arr):
+    while arr is not None and not isinstance(arr, mmap.mmap):
+        arr = getattr(arr, 'base', None)
+    return arr is not None
+
+
+@pytest.fixture
+def samples():
+    return np.random.RandomState(0).randint(
+        -1 << 15, 1 << 15, 8000 * 3).astype(np.int16)
+
+
+@pytest.fixture
+def no_ffmpeg(monkeypatch):
+    def decode(*args):
+        raise AssertionError("decoded by ffmpeg")
+    monkeypatch.setattr(audio, '_decode', decode)
+
+
+# an odd sized chunk before data is padded to an even size
+@pytest.mark.parametrize('extra', [b'', b'LIST\x03\x00\x00\x00abc\x00'])
+def test_load_wav_file(tmp_path, samples, no_ffmpeg, extra):
+    path = tmp_path / 'clip.wav'
+    path.write_bytes(_wav(samples, extra=extra))
+    loaded = audio.load_audio(str(path))
+    assert np.array_equal(loaded, samples)
+    assert _mapped(loaded) and not loaded.flags.writeable
+    assert np.array_equal(audio.load_audio(str(path), snip=1.5),
+                          samples[:12000])
+
+
+def test_load_wav_file_native_rate(tmp_path, samples, no_ffmpeg):
+    path = tmp_path / 'clip.wav'
+    path.write_bytes(_wav(samples, rate=44100, channels=2))
+    loaded = audio.load_audio(str(path), downsample=False, snip=0.1)
+    assert np.array_equal(loaded, samples[:4410 * 2])
+
+
+def test_load_wav_needing_conversion(tmp_path, samples, monkeypatch):
+    calls = []
+
+    def decode(source, sampleRate, downsample, snip):
+        calls.append((source, sampleRate, downsample, snip))
+        return samples
+    monkeypatch.setattr(audio, '_decode', decode)
+    path = str(tmp_path / 'clip.wav')
+    with open(path, 'wb') as f:
+        f.write(_wav(samples, rate=44100))
+    assert np.array_equal(audio.load_audio(path, snip=1), samples[:8000])
+    # loudness is measured before snipping
+    normalized = audio.load_audio(path, normalize=True, snip=1)
+    assert np.array_equal(normalized, audio._normalize(samples, -20)[:8000])
+    assert calls == [(path, 8000, True, 1), (path, 8000, True, None)]
+
+
+def test_load_native_rate_audio(monkeypatch, mp3):
+    calls = []
+
+    def decode(*args):
+        calls.append(args)
+        return np.arange(100, dtype=np.int16)
+    monkeypatch.setattr(audio, '_decode', decode)
+    # the native sample rate is unknown here, so ffmpeg snips
+    loaded = audio.load_audio(mp3, downsample=False, normalize=True, snip=1)
+    assert len(loaded) == 100
+    assert calls == [(mp3, 8000, False, 1)]
+
+
+def test_load_wav_bytes(samples, no_ffmpeg):
+    data = _wav(samples)
+    for source in (data, bytearray(data), io.BytesIO(data)):
+        loaded = audio.load_audio(source, snip=1)
+        assert np.array_equal(loaded, samples[:8000])
+        assert not _mapped(loaded)
+        assert loaded.flags.writeable == isinstance(source, bytearray)
+
+
+def test_load_array(samples, no_ffmpeg):
+    assert audio.load_audio(samples) is samples
+    assert np.array_equal(audio.load_audio(samples, snip=2),
+                          samples[:16000])
+    loaded = audio.load_audio(samples.astype(np.float64))
+    assert loaded.dtype == np.int16 and np.array_equal(loaded, samples)
+    normalized = audio.load_audio(samples // 100, normalize=True)
+    assert normalized.dtype == np.int16
+    assert np.abs(normalized).mean() > np.abs(samples // 100).mean()
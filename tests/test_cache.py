@@ -0,0 +1,33 @@
+import numpy as np
+
+from qfp.cache import LRUCache
+
+
+def _value(n):
+    return (np.zeros(n, dtype=np.uint8),)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(3 * (8 + 100))
+    cache.put_many([(i, _value(100)) for i in range(3)], cache.generation)
+    # 0 becomes the most recently used, so 1 is evicted next
+    assert [v is not None for v in cache.get_many([0, 5])] == [True, False]
+    cache.put_many([(3, _value(100))], cache.generation)
+    assert [v is not None for v in cache.get_many(range(4))] == [
+        True, False, True, True]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (4, 2)
+    assert (stats['entries'], stats['size']) == (3, 3 * 108)
+
+
+def test_lru_cache_skips_results_of_invalidated_lookups():
+    cache = LRUCache(1 << 20)
+    generation = cache.generation
+    cache.discard([1])
+    cache.put_many([(1, _value(10))], generation)
+    assert len(cache) == 0
+    cache.put_many([(1, _value(10)), (2, _value(10))], cache.generation)
+    cache.discard([1])
+    assert cache.get_many([1, 2])[0] is None and len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['size'] == 0
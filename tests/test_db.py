@@ -0,0 +1,168 @@
+import copy
+import threading
+
+import pytest
+
+from benchmarks.synth import SAMPLE_RATE, track, add_noise
+from qfp import ReferenceFingerprint, QueryFingerprint
+from qfp.db import QfpDB
+from qfp.index import GridIndex
+
+
+@pytest.fixture(scope='module')
+def references():
+    fps = []
+    for seed in range(4):
+        fp = ReferenceFingerprint(track(20, seed))
+        fp.create()
+        fps.append(fp)
+    return fps
+
+
+def _count(db, table):
+    c = db.connection().execute("SELECT COUNT(*) FROM %s" % table)
+    return c.fetchone()[0]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_store_from_threads(tmp_path, references, compact):
+    db = QfpDB(str(tmp_path / 'qfp.db'), compact=compact)
+    errors = []
+
+    def store(i):
+        try:
+            db.store(references[i % 4], 'track %d' % i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert db.titles() == set('track %d' % i for i in range(8))
+
+
+def test_store_many_batches_interleaved_with_store(tmp_path, references):
+    path = str(tmp_path / 'qfp.db')
+    db = QfpDB(path)
+    other = QfpDB(path)
+
+    def catalog():
+        for i in range(4):
+            yield references[i], 'bulk %d' % i
+            # another connection writes between the batches
+            if i % 2:
+                other.store(references[i], 'single %d' % i)
+
+    db.store_many(catalog(), batch_size=2)
+    assert len(db.titles()) == 6
+    assert _count(db, 'Quads') == _count(db, 'Hashes')
+    assert _count(db, 'Quads') == sum(
+        len(references[i].strongest) for i in (0, 1, 2, 3, 1, 3))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('cache_size', [0, 2 ** 20])
+def test_query_skips_records_deleted_after_index_build(
+        tmp_path, references, compact, cache_size):
+    path = str(tmp_path / 'qfp.db')
+    db = QfpDB(path, compact=compact)
+    for i in range(4):
+        db.store(references[i], 'track %d' % i)
+    GridIndex.build(db, str(tmp_path / 'qfp.idx'))
+    db = QfpDB(path, index=GridIndex(str(tmp_path / 'qfp.idx')),
+               cache_size=cache_size)
+    clip = track(20, 1)[2 * SAMPLE_RATE:18 * SAMPLE_RATE]
+    fp = QueryFingerprint(add_noise(clip, 20))
+    fp.create()
+    db.query(fp, vThreshold=0)
+    assert 'track 1' in set(m.record for m in fp.matches)
+    db.delete('track 1')
+    db.query(fp, vThreshold=0)
+    assert fp.match_candidates
+    assert set(m.record for m in fp.matches) <= set(['track 0', 'track 2',
+                                                     'track 3'])
+    assert None not in [m.record for m in db.query_top(fp, vThreshold=0)]
+
+
+@pytest.fixture
+def catalog_db(tmp_path, catalog):
+    db = QfpDB(str(tmp_path / 'catalog.db'))
+    db.store_many((fp, title) for title, fp in catalog.items())
+    return db
+
+
+def test_query_top_matches_query(catalog_db, clips):
+    db = catalog_db
+    for fp in clips.values():
+        db.query(fp)
+        matches = fp.matches
+        best = sorted(matches, key=lambda m: m.vScore, reverse=True)[:1]
+        # query lists the matches in order of validation, most matching
+        # quads first: a single chunk validates the same one first
+        top = db.query_top(fp, k=1, chunk=len(fp.hashes))
+        assert [tuple(m[:3]) for m in top] == [tuple(m) for m in
+                                               matches[:1]]
+        # a margin never reached validates every candidate
+        top = db.query_top(fp, k=1, margin=1.0)
+        assert [(m.record, m.vScore) for m in top] == [
+            (m.record, m.vScore) for m in best]
+
+
+def test_compact_format_matches_rtree(tmp_path, catalog, query_all,
+                                      expected):
+    db = QfpDB(str(tmp_path / 'compact.db'), compact=True)
+    db.store_many((fp, title) for title, fp in catalog.items())
+    assert query_all(db) == expected
+
+
+@pytest.mark.parametrize('margin', [None, 0.1])
+def test_query_many_matches_query(catalog_db, clips, margin):
+    fps = list(clips.values())
+    expected = []
+    for fp in fps:
+        catalog_db.query(fp, vThreshold=0.3, margin=margin)
+        expected.append((fp.match_candidates, fp.matches))
+    batch = [copy.copy(fp) for fp in fps]
+    matches = catalog_db.query_many(batch, vThreshold=0.3, margin=margin)
+    assert matches == [m for _, m in expected]
+    assert [(fp.match_candidates, fp.matches) for fp in batch] == expected
+    assert expected[-1] == ([], [])
+
+
+def test_caches_follow_store_and_delete(tmp_path, catalog, clips):
+    cached = QfpDB(str(tmp_path / 'cached.db'), cache_size=1 << 24)
+    plain = QfpDB(str(tmp_path / 'plain.db'))
+    titles = list(catalog)
+
+    def check():
+        # a cached db always answers like one without caches
+        for fp in clips.values():
+            cached.query(fp, vThreshold=0)
+            matches = fp.matches
+            plain.query(fp, vThreshold=0)
+            assert matches == fp.matches
+
+    for db in (cached, plain):
+        db.store_many((catalog[title], title) for title in titles[:-1])
+    check()
+    stats = cached.cache_stats()
+    assert stats['hashes']['hits'] == 0 and stats['hashes']['misses'] > 0
+    check()
+    again = cached.cache_stats()
+    assert again['hashes']['misses'] == stats['hashes']['misses']
+    assert again['hashes']['hits'] == stats['hashes']['misses']
+    assert again['peaks']['hits'] > 0
+    # the record stored, deleted, then its id reused by another record
+    for db in (cached, plain):
+        db.store(catalog[titles[-1]], titles[-1])
+    assert cached.cache_stats()['hashes']['entries'] == 0
+    check()
+    for db in (cached, plain):
+        db.delete(titles[-1])
+    check()
+    for db in (cached, plain):
+        db.store(catalog[titles[1]], 'copy')
+    check()
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.synth import track
+from qfp import ReferenceFingerprint
+from qfp.db import QfpDB
+from qfp.index import GridIndex
+from qfp.snapshot import SnapshotQfpDB, FILES
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['rtree',
+                                                           'compact'])
+def db(request, tmp_path_factory):
+    path = tmp_path_factory.mktemp('db') / 'qfp.db'
+    db = QfpDB(str(path), compact=request.param)
+    for seed in range(3):
+        fp = ReferenceFingerprint(track(20, seed))
+        fp.create()
+        db.store(fp, 'track %d' % seed)
+    return db
+
+
+def _same_files(a, b, names):
+    for name in names:
+        assert np.array_equal(np.load(os.path.join(a, name + '.npy')),
+                              np.load(os.path.join(b, name + '.npy')))
+
+
+def test_grid_index_built_in_chunks(db, tmp_path):
+    whole = GridIndex.build(db, str(tmp_path / 'whole'))
+    assert len(whole) > 300
+    assert np.all(np.diff(whole.keys) >= 0)
+    GridIndex.build(db, str(tmp_path / 'chunks'), chunksize=29, buckets=7)
+    _same_files(str(tmp_path / 'whole'), str(tmp_path / 'chunks'),
+                GridIndex.FILES)
+    assert sorted(os.listdir(str(tmp_path / 'chunks'))) == sorted(
+        [name + '.npy' for name in GridIndex.FILES] + ['meta.json'])
+
+
+def test_snapshot_built_in_chunks(db, tmp_path):
+    whole = SnapshotQfpDB.build(db, str(tmp_path / 'whole'))
+    SnapshotQfpDB.build(db, str(tmp_path / 'chunks'), chunksize=29)
+    _same_files(str(tmp_path / 'whole'), str(tmp_path / 'chunks'), FILES)
+    assert whole.titles() == db.titles()
+    assert np.all(np.diff(whole.peakkeys) >= 0)
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['rtree',
+                                                           'compact'])
+def catalog_db(request, tmp_path_factory, catalog):
+    path = tmp_path_factory.mktemp('catalog') / 'qfp.db'
+    db = QfpDB(str(path), compact=request.param)
+    db.store_many((fp, title) for title, fp in catalog.items())
+    return db
+
+
+def test_grid_index_matches_rtree(catalog_db, tmp_path, query_all,
+                                  expected):
+    index = GridIndex.build(catalog_db, str(tmp_path / 'index'))
+    db = QfpDB(catalog_db.path, index=index)
+    assert query_all(db) == expected
+
+
+def test_snapshot_matches_rtree(catalog_db, tmp_path, query_all, expected):
+    db = SnapshotQfpDB.build(catalog_db, str(tmp_path / 'snapshot'))
+    assert query_all(db) == expected
+    assert query_all(SnapshotQfpDB(str(tmp_path / 'snapshot'))) == expected
@@ -0,0 +1,68 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from qfp.fingerprint import fpType
+from qfp.quads import find_quads
+from qfp.utils import as_peaks, as_quads
+
+
+def reference_quads(peaks, r, c):
+    """
+    The previous enumerator: every itertools.combinations triple of the
+    peaks in the window of each root, then the validity test
+    """
+    peaks = as_peaks(peaks)
+    quads = []
+    for root in peaks:
+        windowStart = root[0] + c - (r / 2)
+        if windowStart > peaks[-1].x:
+            continue
+        lo, hi = np.searchsorted(peaks.x, [windowStart, windowStart + r])
+        window = peaks[lo:hi]
+        if len(window) < 3:
+            continue
+        combs = np.array(list(combinations(range(len(window)), 3)))
+        q = np.empty((len(combs), 8), dtype=np.int32)
+        q[:, 0:2] = root
+        q[:, 2:8] = window[combs].reshape(-1, 6)
+        q = as_quads(q)
+        valid = ((q.A.y < q.C.y) & (q.C.y < q.B.y) &
+                 (q.A.y < q.D.y) & (q.D.y <= q.B.y))
+        quads.append(q[valid])
+    return as_quads(np.concatenate(quads) if quads else [])
+
+
+def random_peaks(seed, n, frames, bins=512):
+    rng = np.random.RandomState(seed)
+    peaks = np.column_stack((rng.randint(0, frames, n),
+                             rng.randint(0, bins, n)))
+    return as_peaks(np.unique(peaks, axis=0))
+
+
+@pytest.mark.parametrize('params', [fpType.Reference, fpType.Query])
+@pytest.mark.parametrize('seed,n,frames', [
+    (0, 120, 1000),    # dense: tens of peaks per window
+    (1, 60, 3000),     # sparse: windows with fewer than 3 peaks
+    (2, 80, 400),      # windows cut off by the last peak
+    (3, 3, 1000),
+    (4, 0, 1000),
+])
+def test_find_quads_matches_combinations(params, seed, n, frames):
+    q, r, c, w, h = params
+    peaks = random_peaks(seed, n, frames)
+    expected = reference_quads(peaks, r, c)
+    quads = find_quads(peaks, r, c)
+    assert quads.dtype == np.int32
+    assert np.array_equal(quads, expected.reshape(-1, 8))
+
+
+def test_find_quads_repeated_values():
+    # peaks sharing X or Y hit every boundary of the validity test
+    x, y = np.meshgrid(np.arange(0, 600, 40), np.arange(0, 50, 10))
+    peaks = as_peaks(np.column_stack((x.ravel(), y.ravel()))[
+        np.lexsort((y.ravel(), x.ravel()))])
+    q, r, c, w, h = fpType.Query
+    assert np.array_equal(find_quads(peaks, r, c),
+                          reference_quads(peaks, r, c))
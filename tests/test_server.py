@@ -0,0 +1,161 @@
+import asyncio
+import io
+import os
+import threading
+import time
+import wave
+
+import pytest
+
+from benchmarks.synth import SAMPLE_RATE
+from qfp import QueryFingerprint
+from qfp.db import QfpDB
+from qfp.server import IdentificationServer, identify, server_stats
+
+
+def _wav(samples):
+    """
+    Returns samples as the bytes of a mono 16-bit WAV file
+    """
+    f = io.BytesIO()
+    w = wave.open(f, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLE_RATE)
+    w.writeframes(samples.astype('<i2').tobytes())
+    w.close()
+    return f.getvalue()
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory, catalog):
+    db = QfpDB(str(tmp_path_factory.mktemp('server') / 'qfp.db'))
+    db.store_many((fp, title) for title, fp in catalog.items())
+    return db
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """
+    Returns function starting an IdentificationServer on a unix socket
+    in an event loop of its own thread. Returns: (server, socket path)
+    """
+    running = []
+
+    def serve(db, **kwargs):
+        server = IdentificationServer(db, workers=1, **kwargs)
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        running.append((server, loop, thread))
+        path = str(tmp_path / 'qfp.sock')
+        asyncio.run_coroutine_threadsafe(server.start(path=path),
+                                         loop).result(30)
+        return server, path
+
+    yield serve
+    for server, loop, thread in running:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result(30)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class BlockingDB:
+    """
+    Holds every query_many until released
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def query_many(self, *args):
+        self.entered.set()
+        self.released.wait(30)
+        return self.db.query_many(*args)
+
+    def cache_stats(self):
+        return self.db.cache_stats()
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_identify(serve, db, clip_samples):
+    server, path = serve(db)
+    for samples in clip_samples.values():
+        fp = QueryFingerprint(samples)
+        fp.create()
+        db.query(fp)
+        matches = identify(_wav(samples), path=path)
+        assert matches == [m._asdict() for m in fp.matches]
+    assert identify(_wav(clip_samples['track 3']), path=path,
+                    vThreshold=1.1) == []
+    stats = server_stats(path=path)
+    assert stats['requests'] == stats['identified'] == len(clip_samples) + 1
+    assert stats['errors'] == stats['rejected'] == 0
+    assert stats['p50'] > 0
+    assert set(stats['cache']) == set(['hashes', 'peaks'])
+
+
+def test_rejects_clips_when_queues_are_full(serve, db, clip_samples):
+    blocking = BlockingDB(db)
+    server, path = serve(blocking, threads=1, queue_size=1, batch_size=1)
+    data = _wav(clip_samples['track 1'])
+    results = []
+    posts = []
+
+    def post():
+        posts.append(threading.Thread(
+            target=lambda: results.append(identify(data, path=path))))
+        posts[-1].start()
+
+    # one clip in the db, one in the query queue, one held by the decode
+    # stage until there is room in it, one in the decode queue
+    post()
+    _wait_for(blocking.entered.is_set)
+    post()
+    _wait_for(lambda: server.query_queue.qsize() == 1)
+    post()
+    _wait_for(lambda: server.counts['requests'] == 3 and
+              server.decode_queue.empty())
+    time.sleep(0.1)
+    post()
+    _wait_for(lambda: server.decode_queue.full())
+    with pytest.raises(IOError, match='503'):
+        identify(data, path=path)
+    blocking.released.set()
+    for thread in posts:
+        thread.join(30)
+    assert len(results) == 4 and all(r == results[0] for r in results)
+    stats = server_stats(path=path)
+    assert (stats['identified'], stats['rejected']) == (4, 1)
+
+
+def _fake_ffmpeg(tmp_path, script):
+    path = tmp_path / 'ffmpeg'
+    path.write_text('#!/bin/sh\n' + script + '\n')
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+
+def test_undecodable_clip(serve, db, tmp_path, monkeypatch):
+    monkeypatch.setenv('FFMPEG_BINARY', _fake_ffmpeg(
+        tmp_path, 'echo "Invalid data found" >&2; exit 1'))
+    server, path = serve(db)
+    with pytest.raises(IOError, match='400.*Invalid data found'):
+        identify(b'not audio', path=path)
+
+
+def test_fingerprinting_failure(serve, db, tmp_path, monkeypatch):
+    monkeypatch.setenv('FFMPEG_BINARY', str(tmp_path / 'missing'))
+    server, path = serve(db)
+    with pytest.raises(IOError, match='500.*fingerprinting failed'):
+        identify(b'not audio', path=path)
+    assert server_stats(path=path)['errors'] == 1
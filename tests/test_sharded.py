@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+
+from qfp.sharded import ShardedQfpDB
+
+
+def test_store_many_with_a_failing_shard(tmp_path, catalog):
+    db = ShardedQfpDB(str(tmp_path / 'shards'), shards=3)
+    titles = ['record %d' % i for i in range(40)]
+    failing = db.shard_of(titles[0])
+
+    def fail(fps, *args):
+        next(fps)
+        raise IOError("shard %d is full" % failing)
+
+    db.shards[failing].store_many = fail
+    fp = catalog['track 1']
+    with pytest.raises(IOError, match='is full'):
+        db.store_many(((fp, title) for title in titles), batch_size=2)
+    # every other shard committed what it got and its thread finished
+    stored = db.titles()
+    assert stored and stored <= set(titles)
+    assert all(db.shard_of(title) != failing for title in stored)
+    shutdown = threading.Thread(target=db.pool.shutdown)
+    shutdown.start()
+    shutdown.join(10)
+    assert not shutdown.is_alive()
+    db.store(fp, 'after')
+    assert 'after' in db.titles()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_sharded_matches_rtree(tmp_path, catalog, query_all, expected,
+                               compact):
+    db = ShardedQfpDB(str(tmp_path / 'shards'), shards=4, compact=compact)
+    db.store_many((fp, title) for title, fp in catalog.items())
+    assert len(set(db.shard_of(title) for title in catalog)) > 1
+    assert query_all(db) == expected
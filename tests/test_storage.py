@@ -0,0 +1,97 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from qfp import QueryFingerprint, ReferenceFingerprint, Storage
+from qfp.fingerprint import fpType
+from qfp.storage import HEADER, load_fingerprint, save_fingerprint
+
+
+def _assert_same(fp, other):
+    assert type(fp) is type(other)
+    assert other.params == fp.params
+    for name in ('peaks', 'strongest', 'hashes'):
+        assert np.array_equal(getattr(other, name), getattr(fp, name))
+
+
+@pytest.mark.parametrize('mmap_mode', ['r', None])
+def test_save_and_load_fingerprint(tmp_path, catalog, clips, mmap_mode):
+    for fp in (catalog['track 1'], clips['track 1'], clips['no match']):
+        path = str(tmp_path / 'fp.qfp')
+        save_fingerprint(fp, path)
+        assert os.listdir(str(tmp_path)) == ['fp.qfp']
+        loaded = load_fingerprint(path, mmap_mode)
+        _assert_same(fp, loaded)
+        assert loaded.path is None
+
+
+def test_load_fingerprint_rejects_bad_files(tmp_path, catalog):
+    path = str(tmp_path / 'fp.qfp')
+    save_fingerprint(catalog['track 1'], path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for bad, error in ((b'RIFF' + data[4:], 'not a fingerprint'),
+                       (data[:HEADER.size - 1], 'not a fingerprint'),
+                       (data[:-100], 'truncated')):
+        with open(path, 'wb') as f:
+            f.write(bad)
+        with pytest.raises(ValueError, match=error):
+            load_fingerprint(path)
+
+
+def test_storage_key(tmp_path, clip_samples):
+    samples = clip_samples['track 1']
+    path = tmp_path / 'clip.raw'
+    data = samples.astype(np.int16).tobytes()
+    path.write_bytes(data)
+    cache = Storage(str(tmp_path / 'cache'))
+    key = cache.key(samples, fpType.Query, 15)
+    # the same audio content, whatever the source, has the same key
+    assert cache.key(data, fpType.Query, 15) == key
+    assert cache.key(str(path), fpType.Query, 15) == key
+    assert cache.key(io.BytesIO(data), fpType.Query, 15) is None
+    others = set([cache.key(samples, fpType.Reference, 15),
+                  cache.key(samples, fpType.Query, None),
+                  cache.key(samples[1:], fpType.Query, 15)])
+    assert len(others) == 3 and key not in others
+
+
+@pytest.mark.parametrize('fingerprint', [ReferenceFingerprint,
+                                         QueryFingerprint])
+def test_create_with_storage(tmp_path, clip_samples, fingerprint):
+    cache = Storage(str(tmp_path / 'cache'))
+    samples = clip_samples['track 3']
+    fp = fingerprint(samples)
+    fp.create(cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert fp.ranks is not None
+    cached = fingerprint(samples.copy())
+    cached.create(cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cached.ranks is None
+    _assert_same(fp, cached)
+    assert len(os.listdir(cache.path)) == 1
+
+
+def test_storage_evicts_least_recently_used(tmp_path, clip_samples):
+    cache = Storage(str(tmp_path / 'cache'))
+    keys = []
+    for title in ('track 1', 'track 3', 'no match'):
+        fp = QueryFingerprint(clip_samples[title])
+        fp.create(cache=cache)
+        keys.append(cache.key(fp.path, fp.params, 15))
+    size = os.path.getsize(cache._file(keys[0]))
+    # keys[0] was used last, so keys[1] goes first
+    for key, used in zip(keys, (300, 100, 200)):
+        os.utime(cache._file(key), (used, used))
+    cache.max_size = sum(os.path.getsize(cache._file(key))
+                         for key in keys) - 1
+    cache.evict()
+    assert [os.path.exists(cache._file(key)) for key in keys] == [
+        True, False, True]
+    cache.max_size = size
+    cache.evict()
+    assert [os.path.exists(cache._file(key)) for key in keys] == [
+        True, False, False]
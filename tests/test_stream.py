@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from benchmarks.synth import SAMPLE_RATE, track
+from qfp.fingerprint import Fingerprint, fpType
+from qfp.stream import (stream_spectrogram, stream_peaks,
+                        stream_fingerprint)
+from qfp.utils import stft, find_peaks
+
+
+@pytest.fixture(scope='module')
+def samples():
+    return track(37, 2)
+
+
+def _blocks(samples, size):
+    return (samples[i:i + size] for i in range(0, len(samples), size))
+
+
+@pytest.mark.parametrize('blocksize', [1000, 80000])
+def test_stream_spectrogram(samples, blocksize):
+    chunks = list(stream_spectrogram(_blocks(samples, blocksize)))
+    assert len(chunks) > 1
+    assert np.array_equal(np.concatenate(chunks), stft(samples))
+
+
+@pytest.mark.parametrize('fp_type', [fpType.Reference, fpType.Query])
+def test_stream_peaks(samples, fp_type):
+    q, r, c, w, h = fp_type
+    spectrogram = stft(samples)
+    chunks = list(stream_peaks(np.array_split(spectrogram, 9), w, h))
+    peaks = np.concatenate([p for p, _ in chunks])
+    expected = find_peaks(spectrogram, w, h)
+    assert np.array_equal(peaks, expected)
+    assert np.array_equal(np.concatenate([m for _, m in chunks]),
+                          spectrogram[expected.x, expected.y])
+
+
+@pytest.mark.parametrize('fp_type', [fpType.Reference, fpType.Query])
+def test_stream_fingerprint(samples, fp_type):
+    fp = Fingerprint(samples, fp_type)
+    fp.create()
+    chunks = list(stream_fingerprint(_blocks(samples, SAMPLE_RATE),
+                                     fp_type))
+    peaks, strongest, hashes = (np.concatenate(arrays)
+                                for arrays in zip(*chunks))
+    assert np.array_equal(peaks, fp.peaks)
+    assert np.array_equal(strongest, fp.strongest)
+    assert np.array_equal(hashes, fp.hashes)
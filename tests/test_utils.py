@@ -0,0 +1,104 @@
+from heapq import nlargest
+
+import numpy as np
+import pytest
+from scipy.ndimage import maximum_filter, minimum_filter
+
+from qfp.utils import (find_peaks, select_strongest, nlargest_indices,
+                       strength_ranks, num_partitions, as_quads)
+
+
+def reference_peaks(spec, maxWidth, maxHeight, minWidth=3, minHeight=3):
+    """
+    The previous find_peaks: both filters over the whole spectrogram
+    """
+    maxima = maximum_filter(spec, footprint=np.ones(
+        (maxWidth, maxHeight), dtype=np.int8))
+    minima = minimum_filter(spec, footprint=np.ones(
+        (minWidth, minHeight), dtype=np.int8))
+    peaks = ((spec == maxima) == (maxima != minima))
+    return np.transpose(np.nonzero(peaks))
+
+
+def reference_strongest(quads, strength, n, l=250):
+    """
+    The previous select_strongest: heapq.nlargest in every partition
+    """
+    numPartitions = quads[-1].A.x // l if len(quads) else 0
+    bounds = np.append(np.searchsorted(quads.A.x,
+                                       np.arange(numPartitions) * l),
+                       len(quads))
+    idx = [start + np.array(nlargest(n, range(end - start),
+                                     strength[start:end].__getitem__),
+                            dtype=np.intp)
+           for start, end in zip(bounds[:-1], bounds[1:])]
+    return quads[np.concatenate(idx + [np.array([], dtype=np.intp)])]
+
+
+def _random_quads(rng, m, frames):
+    quads = rng.randint(0, 500, (m, 8)).astype(np.int32)
+    quads[:, 0] = np.sort(rng.randint(0, frames, m))
+    return as_quads(quads)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_strength_ranks(seed):
+    rng = np.random.RandomState(seed)
+    quads = _random_quads(rng, 3000, rng.choice([600, 3740, 5000]))
+    strength = rng.rand(len(quads))
+    strongest, ranks = select_strongest(quads, strength, 9,
+                                        return_ranks=True)
+    assert np.array_equal(
+        strength_ranks(strongest, num_partitions(quads)), ranks)
+    # the last partition takes the quads after it: one quad of every
+    # partition is the strongest
+    assert (ranks == 0).sum() == num_partitions(quads)
+    assert ranks.max() == 8
+
+
+def _spectrogram(kind, shape, rng):
+    spec = rng.rand(*shape) * 60
+    if kind == 'quantized':
+        # plateaus of equal values
+        spec = np.round(spec / 20)
+    elif kind == 'partly zero':
+        spec[shape[0] // 3:2 * shape[0] // 3] = 0
+        spec[:, :shape[1] // 4] = 0
+    elif kind == 'zero':
+        spec[:] = 0
+    return spec.astype(np.float32)
+
+
+@pytest.mark.parametrize('kind', ['random', 'quantized', 'partly zero',
+                                  'zero'])
+@pytest.mark.parametrize('shape,size', [
+    ((301, 64), (151, 75)),
+    ((300, 63), (150, 20)),
+    ((97, 40), (8, 5)),
+])
+@pytest.mark.parametrize('tile,workers', [(4096, 1), (64, 1), (7, 3)])
+def test_find_peaks_matches_filters(kind, shape, size, tile, workers):
+    spec = _spectrogram(kind, shape, np.random.RandomState(len(kind)))
+    peaks = find_peaks(spec, size[0], size[1], workers=workers, tile=tile)
+    assert peaks.dtype == np.int32
+    assert np.array_equal(peaks.reshape(-1, 2),
+                          reference_peaks(spec, *size))
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('n', [1, 9, 40])
+def test_select_strongest_matches_nlargest(seed, n):
+    rng = np.random.RandomState(seed)
+    quads = _random_quads(rng, rng.randint(0, 2000),
+                          rng.choice([200, 600, 3740]))
+    # few distinct strengths: many ties
+    strength = rng.randint(0, 4 if seed % 2 else 1000, len(quads))
+    assert np.array_equal(select_strongest(quads, strength, n),
+                          reference_strongest(quads, strength, n))
+
+
+@pytest.mark.parametrize('n', [0, 1, 5, 20])
+def test_nlargest_indices(n):
+    strength = np.array([3, 1, 3, 2, 5, 1, 3, 5], dtype=np.float32)
+    expected = nlargest(n, range(len(strength)), strength.__getitem__)
+    assert nlargest_indices(strength, n).tolist() == expected